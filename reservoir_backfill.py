@@ -0,0 +1,258 @@
+import os
+import time
+
+
+def parse_log_files(paths):
+    """
+    Reads a shard of log files in a worker process, returning the LogFiles that could be read and the
+    LogFormatErrors of those that couldn't.
+    """
+    from reservoir_nmhc import read_log_file, LogRecord
+
+    logs = []
+    errors = []
+    for path in paths:
+        log = read_log_file(path, errors, LogRecord)  # records are much cheaper to make and send back
+        if log is not None:
+            logs.append(log)
+
+    return logs, errors
+
+
+def parse_pa_lines(lines):
+    """
+    Parses a shard of PA log lines (as bytes) into columns in a worker process, returning (names, pa_lines) as
+    read_pa_columns does, with dates corrected. Columns are much cheaper to send back than NmhcLines and Peaks.
+    """
+    from reservoir_nmhc import read_pa_columns, fix_line_date
+
+    names, pa_lines = read_pa_columns([line.decode(errors='replace') for line in lines])
+
+    return names, [(fix_line_date(date), *columns) for date, *columns in pa_lines]
+
+
+def backfill_logs(Session, executor, logpath, shard_size):
+    """
+    Loads every log file in logpath that isn't already in the db, parsing shards of files in parallel and
+    committing each shard as it's parsed, so an interrupted backfill only redoes the shards it hadn't committed.
+    Files that couldn't be parsed are summarized at the end. Returns the number of logs loaded.
+    """
+    from reservoir_nmhc import LogFile, fix_off_dates, bulk_insert_logs, chunked
+
+    session = Session()
+    logs_in_db = {name for name, in session.query(LogFile.filename)}
+    session.close()
+
+    with os.scandir(logpath) as files:
+        logfns = sorted(file.name for file in files if 'l.txt' in file.name and file.name not in logs_in_db)
+
+    paths = [os.path.join(logpath, log) for log in logfns]
+
+    loaded = 0
+    errors = []
+    for logs, shard_errors in executor.map(parse_log_files, chunked(paths, shard_size)):
+        errors.extend(shard_errors)
+        fix_off_dates(logs, [])
+
+        session = Session()
+        bulk_insert_logs(session, logs)
+        session.commit()
+        session.close()
+
+        loaded += len(logs)
+        print(f'{loaded} of {len(paths)} new log files loaded.')
+
+    if len(errors) != 0:
+        print(f'{len(errors)} log files could not be parsed:')
+        for error in errors:
+            print(f'    {error}')
+
+    return loaded
+
+
+def backfill_pa_lines(Session, executor, pa_path, shard_size):
+    """
+    Loads every line of the PA log past its stored FileCheckpoint, parsing shards of lines in parallel. Each
+    shard's lines are committed together with the checkpoint advanced past them, so an interrupted backfill
+    resumes from the first uncommitted shard, exactly as the loop would. Returns the number of lines loaded.
+
+    The checkpoint is read in its own short session, and each shard is written in another, so no transaction is
+    held open while the file is read or parsed.
+    """
+    from reservoir_nmhc import FileCheckpoint, read_new_lines, bulk_insert_pa_columns, chunked
+
+    filename = os.path.basename(pa_path)
+
+    if not os.path.isfile(pa_path):
+        print(f'PA file {pa_path} did not exist!')
+        return 0
+
+    session = Session()
+    checkpoint = session.query(FileCheckpoint).filter(FileCheckpoint.filename == filename).one_or_none()
+
+    if checkpoint is None:
+        checkpoint = FileCheckpoint(filename)
+
+    session.close()  # the checkpoint is kept detached while reading, and merged back in with each shard
+
+    contents = read_new_lines(pa_path, checkpoint, keepends=True, decode=False)  # bytes, so lengths are exact
+
+    end = checkpoint.offset
+    offset = end - sum(len(line) for line in contents)  # where this read started
+
+    loaded = 0
+    line_shards = list(chunked(contents, shard_size))
+    for shard, (names, new_lines) in zip(line_shards, executor.map(parse_pa_lines, line_shards)):
+        offset += sum(len(line) for line in shard)
+        checkpoint.offset = offset  # only past the lines committed so far
+
+        session = Session()
+        bulk_insert_pa_columns(session, names, new_lines)  # duplicate dates are ignored by the db
+        checkpoint = session.merge(checkpoint)
+        session.flush()
+        session.expunge(checkpoint)  # before the commit expires it, so it can be used detached
+        session.commit()
+        session.close()
+
+        loaded += len(new_lines)
+        print(f'{loaded} of {len(contents)} new PA lines loaded.')
+
+    checkpoint.offset = end  # stored even if there were no new lines, to record the file's inode and size
+
+    session = Session()
+    session.merge(checkpoint)
+    session.commit()
+    session.close()
+
+    return loaded
+
+
+def backfill_runs(Session):
+    """
+    Matches all single logs and lines into runs, makes any acetylene/n-butane corrections, and commits them
+    together. The matching and corrections are done on records rather than ORM objects, and written in bulk.
+    Returns the number of runs created.
+    """
+    from reservoir_nmhc import load_single_records, match_log_to_pa, check_c4_rts, bulk_insert_runs, RunRecord
+
+    session = Session()
+
+    LogRecords, LineRecords = load_single_records(session)
+
+    RunRecords = match_log_to_pa(LogRecords, LineRecords, run_factory=RunRecord)
+
+    for run in RunRecords:
+        check_c4_rts(run)
+
+    bulk_insert_runs(session, RunRecords)
+    session.commit()
+    session.close()
+
+    return len(RunRecords)
+
+
+def backfill_crfs(Session, crf_path):
+    """Stores any new or revised CRFs, reintegrating the runs they apply to. Returns the number reintegrated."""
+    from reservoir_nmhc import read_crf_data, reintegrate_changed_crfs
+
+    Crfs = read_crf_data(crf_path)
+
+    if Crfs is None:
+        return 0
+
+    session = Session()
+    reintegrated = reintegrate_changed_crfs(session, Crfs)
+    session.commit()
+    session.close()
+
+    return len(reintegrated)
+
+
+def backfill_data(Session, batch_size):
+    """
+    Corrects and integrates every un-integrated run in batches, committing each batch's data along with its
+    MixingRatios and DailySummary rows, so an interrupted backfill resumes with the runs still un-integrated.
+    Returns the number of runs integrated.
+    """
+    from reservoir_nmhc import GcRun, Crf, Datum, CrfIndex, check_c4_rts, integrate_batch, chunked
+    from reservoir_nmhc import refresh_mixing_ratios, refresh_daily_summaries
+
+    session = Session()
+    run_ids = [run_id for run_id, in session.query(GcRun.id).filter(GcRun.data_id == None).order_by(GcRun.id)]
+    session.close()
+
+    integrated = 0
+    for batch in chunked(run_ids, batch_size):
+        session = Session()
+
+        GcRuns = session.query(GcRun).filter(GcRun.id.in_(batch)).order_by(GcRun.id).all()
+        crf_index = CrfIndex(session.query(Crf).all())
+
+        for run in GcRuns:
+            check_c4_rts(run)  # make any possible acetylene/nbutane corrections; a no-op if already made
+            run.crfs = crf_index.find(run.date_end)
+
+        data = [Datum(run) for run in integrate_batch(session, GcRuns)]
+        session.add_all(data)
+
+        ids = [datum.run_con.id for datum in data]
+        refresh_mixing_ratios(session, ids)
+        refresh_daily_summaries(session, ids)
+
+        session.commit()
+        session.close()
+
+        integrated += len(data)
+        print(f'{integrated} runs integrated; {len(GcRuns) - len(data)} in this batch could not be.')
+
+    return integrated
+
+
+def backfill(directory, engine_str, logpath, pa_filename, crf_filename, workers, shard_size, batch_size):
+    """
+    Loads the full log and PA archive into the db and integrates it, parsing in a pool of worker processes.
+    Everything is committed in shards and only missing work is done, so re-running after an interruption (or
+    on an up-to-date db) picks up where it left off.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from reservoir_nmhc import get_reservoir_engine
+
+    engine, Session = get_reservoir_engine(engine_str, directory, write=True)  # every stage here writes
+
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        logs = backfill_logs(Session, executor, os.path.join(directory, logpath), shard_size)
+        print(f'Loaded {logs} log files in {time.perf_counter() - start:.1f}s.')
+
+        lines = backfill_pa_lines(Session, executor, os.path.join(directory, pa_filename), shard_size * 10)
+        print(f'Loaded {lines} PA lines in {time.perf_counter() - start:.1f}s.')
+
+    runs = backfill_runs(Session)
+    print(f'Matched {runs} new runs in {time.perf_counter() - start:.1f}s.')
+
+    reintegrated = backfill_crfs(Session, os.path.join(directory, crf_filename))
+    print(f'Reintegrated {reintegrated} runs for changed CRFs in {time.perf_counter() - start:.1f}s.')
+
+    integrated = backfill_data(Session, batch_size)
+    print(f'Integrated {integrated} runs in {time.perf_counter() - start:.1f}s.')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load and integrate the full log and PA archive in bulk. '
+                                                 + 'Safe to re-run; only missing work is done.')
+    parser.add_argument('--directory', default=os.getcwd(), help='directory holding the data and db')
+    parser.add_argument('--db', default='sqlite:///reservoir.sqlite', help='database to load into')
+    parser.add_argument('--logs', default='log', help='directory of LabView log files, relative to directory')
+    parser.add_argument('--pa', default='NMHC_PA.LOG', help='PA log file, relative to directory')
+    parser.add_argument('--crfs', default='reservoir_CRFs.txt', help='CRF file, relative to directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='parsing processes to use')
+    parser.add_argument('--shard-size', type=int, default=200, help='log files per parsing shard and commit')
+    parser.add_argument('--batch-size', type=int, default=2000, help='runs integrated per commit')
+
+    args = parser.parse_args()
+
+    backfill(args.directory, args.db, args.logs, args.pa, args.crfs, args.workers, args.shard_size,
+             args.batch_size)
@@ -4,6 +4,7 @@ import asyncio
 homedir = os.getcwd()
 locallogdir = 'log'
 plotdir = 'plots'
+retry_delay = 10  # seconds before the events of a failed stage cycle are put back on its queue
 
 
 def print_now(string):
@@ -12,385 +13,753 @@ def print_now(string):
     print(f"{string} - {datetime.now().isoformat(' ')}")
 
 
-async def check_load_logs(logpath, homedir, sleeptime):
+async def drain_queue(queue):
+    """Waits for at least one item on the queue, then returns it and anything else already waiting as a list."""
+    items = [await queue.get()]
+
+    while not queue.empty():
+        items.append(queue.get_nowait())
+
+    return items
+
+
+async def run_blocking(func, *args):
+    """
+    Runs func(*args) in the loop's default executor, a small ThreadPoolExecutor set up in __main__, and returns its
+    result. Stages do all their db and file work this way, so a big commit or a long file read in one stage
+    overlaps with the others instead of stalling the event loop.
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def run_stage(func, *args, default=None, retry=None):
+    """
+    Runs a stage's blocking work with run_blocking() and returns its result. If it raises (ie a lock timeout, or
+    an IntegrityError from a bad CRF file), the error is printed and default is returned instead, so one failed
+    cycle is reported and the stage keeps waiting for events rather than ending for good. The blocking functions
+    roll back their sessions before re-raising.
+
+    retry: tuple, of (queue, events); if the work fails, the events it was handling are put back on the stage's
+        queue after retry_delay seconds, so they're retried rather than lost
+    """
+    import traceback
+
+    try:
+        return await run_blocking(func, *args)
+    except Exception as e:
+        print_now(f'{func.__name__}() failed: {e!r}')
+        traceback.print_exc()
+
+        if retry is not None:
+            queue, events = retry
+            print(f'It will be retried in {retry_delay} seconds.')
+            asyncio.get_event_loop().call_later(retry_delay, requeue, queue, events)
+
+        return default
+
+
+def requeue(queue, events):
+    """Puts the events of a failed stage cycle back on its queue."""
+    for event in events:
+        queue.put_nowait(event)
+
+
+def report_stage_exit(task):
+    """Reports a stage's task ending, which only happens if something outside of run_stage() raised."""
+    if not task.cancelled() and task.exception() is not None:
+        print_now(f'Stage {task.get_coro().__name__}() stopped: {task.exception()!r}')
+
+
+def rollback(session):
+    """Rolls back and closes a session whose work failed, so its transaction and connection aren't left open."""
+    session.rollback()
+    session.close()
+
+
+def merge_events(events):
+    """
+    Merges the events drained from a stage's queue. Each event is a list of the ids of new items for the stage,
+    or None to have the stage check everything pending; returns a set of ids, or None if any event was None.
+    """
+    ids = set()
+
+    for event in events:
+        if event is None:
+            return None
+        ids.update(event)
+
+    return ids
+
+
+async def watch_files(logpath, pa_filename, directory, log_queue, pa_queue, sleeptime):
+    """
+    Reports new log files and changes to the PA log to the ingest coroutines as they happen. Everything already
+    on disk is reported once at startup.
+
+    On Linux, inotify pushes an event when a log file is finished being written (or moved in) and whenever the
+    PA log is appended to, so nothing is touched while the instrument is idle. The PA log itself is watched for
+    appends, and its directory only for it being created or replaced, so writes to the db beside it don't wake
+    anything. If the kernel's event queue overflows, events may have been lost, so the log directory is rescanned
+    and the PA log re-read. Elsewhere, this falls back to polling the log directory and the PA log's size every
+    sleeptime seconds.
+
+    log_queue: asyncio.Queue, receives the filename of each new log file
+    pa_queue: asyncio.Queue, receives pa_filename each time the PA log may have changed
+    """
+    from reservoir_nmhc import InotifyWatcher
+
+    pa_path = os.path.join(directory, pa_filename)
+
+    def is_log(name):
+        return 'l.txt' in name
+
+    def scan_logs():
+        """Returns {filename: (size, mtime)} for each log file in logpath."""
+        logs = {}
+        with os.scandir(logpath) as files:
+            for file in files:
+                if is_log(file.name):
+                    try:
+                        stat = file.stat()
+                    except FileNotFoundError:
+                        continue  # removed since it was listed
+                    logs[file.name] = (stat.st_size, stat.st_mtime_ns)
+        return logs
+
+    log_stats = scan_logs()
+    seen_logs = set(log_stats)
+
+    for log in sorted(seen_logs):
+        log_queue.put_nowait(log)
+    pa_queue.put_nowait(pa_filename)
+
+    def rescan():
+        """Reports any logs that arrived unseen, and has the PA log re-read from its checkpoint."""
+        logfns = set(scan_logs())
+
+        for log in sorted(logfns - seen_logs):
+            log_queue.put_nowait(log)
+        seen_logs.update(logfns)
+
+        pa_queue.put_nowait(pa_filename)
+
+    try:
+        watcher = InotifyWatcher()
+        log_wd = watcher.add_watch(logpath, InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MOVED_TO)
+        dir_wd = watcher.add_watch(directory, InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MOVED_TO
+                                   | InotifyWatcher.IN_CREATE)
+    except OSError as e:
+        print(f'File events were not available ({e}), polling for new files instead.')
+        watcher = None
+
+    if watcher is not None:
+        def watch_pa_file():
+            """(Re)watches the PA log itself for appends, returning its watch descriptor, or None if it's missing."""
+            try:
+                return watcher.add_watch(pa_path, InotifyWatcher.IN_MODIFY)
+            except OSError:
+                return None
+
+        pa_wd = watch_pa_file()
+
+        def push_events():
+            nonlocal pa_wd
+
+            for wd, name, mask in watcher.read_events():
+                if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                    print_now('File events overflowed, rescanning for new files.')
+                    pa_wd = watch_pa_file()
+                    rescan()
+                elif wd == log_wd and is_log(name):
+                    seen_logs.add(name)
+                    log_queue.put_nowait(name)
+                elif wd == dir_wd and name == pa_filename:
+                    pa_wd = watch_pa_file()  # a created or replaced PA log needs a watch on the new file
+                    pa_queue.put_nowait(name)
+                elif wd == pa_wd:
+                    if mask & InotifyWatcher.IN_IGNORED:
+                        pa_wd = watch_pa_file()  # the watched file went away; watch any file now in its place
+                    pa_queue.put_nowait(pa_filename)
+
+        loop = asyncio.get_event_loop()
+        loop.add_reader(watcher.fileno(), push_events)
+
+        try:
+            await asyncio.Future()  # events are pushed by the reader callback until this is cancelled
+        finally:
+            loop.remove_reader(watcher.fileno())
+            watcher.close()
+
+    pa_size = os.path.getsize(pa_path) if os.path.isfile(pa_path) else None
+
+    while True:  # polling fallback
+        await asyncio.sleep(sleeptime)
+
+        # without a close event, a log can be seen while it's still being written and fail to load; any log that
+        # changed since the last poll is reported again so it's retried, and load_logs() skips those already loaded
+        new_stats = scan_logs()
+
+        for log in sorted(name for name, stats in new_stats.items() if log_stats.get(name) != stats):
+            log_queue.put_nowait(log)
+        log_stats = new_stats
+
+        new_pa_size = os.path.getsize(pa_path) if os.path.isfile(pa_path) else None
+        if new_pa_size != pa_size:
+            pa_size = new_pa_size
+            pa_queue.put_nowait(pa_filename)
+
+
+def load_logs(logpath, homedir, logfns):
+    '''
+    Loads any of the given log files that aren't already in the db, and returns how many were loaded. The files
+    are read outside of any transaction, so the db is only locked for the checks and the insert.
+    '''
+    from reservoir_nmhc import connect_to_reservoir_db, LogFile, LogRecord, fix_off_dates, read_log_file
+    from reservoir_nmhc import bulk_insert_logs, chunked
+
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', homedir)
+
+    logs_in_db = set()  # only check the reported names, rather than loading every log in the db
+    try:
+        for names in chunked(set(logfns)):
+            logs_in_db.update(name for name, in session.query(LogFile.filename).filter(LogFile.filename.in_(names)))
+    finally:
+        session.close()
+
+    logs_to_load = sorted(set(logfns) - logs_in_db)  # add files if not in the database filenames
+
+    if len(logs_to_load) is 0:
+        print('No new logs were found.')
+        return 0
+
+    new_logs = []
+    for log in logs_to_load:
+        new_log = read_log_file(os.path.join(logpath, log), factory=LogRecord)  # only ever bulk inserted
+        if new_log is not None:
+            new_logs.append(new_log)
+
+    if len(new_logs) != 0:
+        fix_off_dates(new_logs, [])
+
+        engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', homedir, write=True)
+        try:
+            bulk_insert_logs(session, new_logs)  # logs loaded by anything else in the meantime are ignored by the db
+            session.commit()
+        except Exception:
+            rollback(session)
+            raise
+        session.close()
+
+        print('New logs were added!')
+
+    return len(new_logs)
+
+
+async def check_load_logs(logpath, homedir, log_queue, match_queue):
     '''
-    Checks the directory against the database for new log files. Loads and commits
-    to db if there are any new files.
+    Loads and commits new log files to the db as they arrive.
 
-    Basic format: Connect to the db, check for new log files. If new files
-    exist, load and commit them to the db. In all cases, sleep for 30s before
-    looping back.
+    Basic format: Wait for watch_files() to report new log filenames, then load and commit any of them that
+    aren't already in the db with load_logs(), and tell create_gc_runs() there's something new to match.
     '''
 
     while True:
-        from reservoir_nmhc import connect_to_reservoir_db, TempDir, LogFile, fix_off_dates, read_log_file
+        logfns = await drain_queue(log_queue)
 
-        engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', homedir)
-        Base.metadata.create_all(engine)
+        if await run_stage(load_logs, logpath, homedir, logfns, default=0, retry=(log_queue, logfns)) != 0:
+            match_queue.put_nowait(None)
 
-        LogFiles = session.query(LogFile).order_by(LogFile.id).all()  # list of all log objects
 
-        with os.scandir(logpath) as files:
-            logfns = [file.name for file in files if 'l.txt' in file.name]
+def load_pa_lines(filename, directory):
+    """
+    Reads any lines appended to the PA log since the checkpoint stored in the db, so only new bytes are ever read,
+    even after a restart. Any new lines are added as objects and committed together with the advanced checkpoint.
+    Returns the number of new lines.
+    """
+    from reservoir_nmhc import connect_to_reservoir_db, FileCheckpoint, fix_line_date, read_pa_columns
+    from reservoir_nmhc import read_new_lines, bulk_insert_pa_columns
+
+    from pathlib import Path
 
-        if len(logfns) is 0:
-            await asyncio.sleep(sleeptime)
-            print('There we no log files in the directory!')
-            continue  # no logs in directory? Sleep and look again
+    pa_path = Path(directory)/filename
 
-        logs_in_db = [log.filename for log in LogFiles]  # log names
+    if not os.path.isfile(pa_path):
+        print('PA file did not exist!')
+        return 0
 
-        logs_to_load = []
-        for log in logfns:
-            if log not in logs_in_db:
-                logs_to_load.append(log)  # add files if not in the database filenames
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory, write=True)
 
-        if len(logs_to_load) is 0:
-            print('No new logs were found.')
-            await asyncio.sleep(sleeptime)
+    try:
+        checkpoint = (session.query(FileCheckpoint)
+                      .filter(FileCheckpoint.filename == filename)
+                      .one_or_none())
+
+        if checkpoint is None:
+            checkpoint = FileCheckpoint(filename)  # first read of this file, start from the beginning
+            session.add(checkpoint)
+
+        contents = read_new_lines(pa_path, checkpoint)
+
+        if len(contents) == 0:
+            print('PA file had no new lines, so it was not parsed.')
             session.commit()
             session.close()
-            engine.dispose()
-            await asyncio.sleep(sleeptime)
+            return 0
+
+        names, new_lines = read_pa_columns(contents)  # parsed straight to columns, without an object per peak
+
+        new_lines = [(fix_line_date(date), *columns) for date, *columns in new_lines]  # correct dates if necessary
+
+        if len(new_lines) is 0:
+            print('No new pa lines added.')
         else:
-            new_logs = []
-            with TempDir(logpath):
-                for log in logs_to_load:
-                    new_logs.append(read_log_file(log))
+            bulk_insert_pa_columns(session, names, new_lines)  # duplicate dates are ignored by the db
 
-            if len(new_logs) != 0:
-                fix_off_dates(new_logs, [])
+            print('Some PA lines found and added.')
 
-                for item in new_logs:
-                    session.merge(item)
-                print('New logs were added!')
+        session.commit()  # commits the new lines and the advanced checkpoint together
+    except Exception:
+        rollback(session)
+        raise
 
-            session.commit()
-            session.close()
-            engine.dispose()
-            await asyncio.sleep(sleeptime)
+    session.close()
+
+    return len(new_lines)
 
 
-async def check_load_pas(filename, directory, sleeptime):
+async def check_load_pas(filename, directory, pa_queue, match_queue):
     """
-    Basic format: Checks the file size of the PA log, opens it if it's bigger
-    than before, and reads from the last recorded line onwards. Any new lines
-    are added as objects and committed. All exits sleep for 30s before re-upping.
+    Basic format: Waits for watch_files() to report a change to the PA log, then loads any new lines with
+    load_pa_lines(), and tells create_gc_runs() there's something new to match.
     """
-    pa_file_size = 0  # always assume all lines could be new when initialized
-    start_line = 0  # defaults set for testing, not runtime
 
     while True:
-        from reservoir_nmhc import connect_to_reservoir_db, TempDir, NmhcLine, fix_off_dates, read_pa_line
+        await drain_queue(pa_queue)
+
+        if await run_stage(load_pa_lines, filename, directory, default=0, retry=(pa_queue, [filename])) != 0:
+            match_queue.put_nowait(None)
+
 
-        engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory)
-        Base.metadata.create_all(engine)
+def match_runs(directory):
+    """
+    Matches all single logs and lines into runs, makes any acetylene/n-butane corrections to them, commits them,
+    and returns their ids. The logs, lines and runs are handled as records rather than ORM objects, and the runs
+    are written in bulk, as in the backfill.
+    """
+    print('Running create_gc_runs()')
+    from reservoir_nmhc import connect_to_reservoir_db, load_single_records, match_log_to_pa, check_c4_rts
+    from reservoir_nmhc import bulk_insert_runs, RunRecord
 
-        NmhcLines = session.query(NmhcLine).order_by(NmhcLine.id).all()
-        line_dates = [line.date for line in NmhcLines]
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory, write=True)
 
-        from pathlib import Path
+    try:
+        LogRecords, LineRecords = load_single_records(session)
 
-        pa_path = Path(directory)/filename
+        RunRecords = match_log_to_pa(LogRecords, LineRecords, run_factory=RunRecord)
+        # only single logs and lines are matched, and matching marries them, so runs can't be duplicated
 
-        if os.path.isfile(pa_path):
-            with TempDir(directory):
-                new_file_size = os.path.getsize(filename)
+        for run in RunRecords:
+            check_c4_rts(run)  # make any possible acetylene/nbutane corrections
 
-            if new_file_size > pa_file_size:
-                with TempDir(directory):
-                    contents = open('NMHC_PA.LOG').readlines()
+        run_ids = bulk_insert_runs(session, RunRecords)
+        session.commit()
+    except Exception:
+        rollback(session)
+        raise
 
-                new_lines = []
-                for line in contents[start_line:]:
-                    try:
-                        with TempDir(directory):
-                            new_lines.append(read_pa_line(line))
-                    except:
-                        print('A line in NMHC_PA.LOG was not processed by read_pa_line() due to an exception.')
-                        print(f'The line was: {line}')
+    session.close()
 
-                fix_off_dates([], new_lines)  # correct dates for lines if necessary
+    return run_ids
 
-                if len(new_lines) is 0:
-                    print('No new pa lines added.')
-                    await asyncio.sleep(sleeptime)
-                    continue
 
-                for item in new_lines:
-                    if item.date not in line_dates: #prevents duplicates in db
-                        line_dates.append(item.date) #prevents duplicates in one load
-                        session.merge(item)
+async def create_gc_runs(directory, match_queue, integrate_queue):
+    """
+    Waits for new logs or PA lines to be loaded, then matches all single logs and lines into corrected GcRuns with
+    match_runs(), and passes their ids on to integrate_runs().
+    """
 
-                session.commit()
+    while True:
+        await drain_queue(match_queue)  # every event means the same thing: match all single logs and lines
 
-                start_line = len(contents)
-                pa_file_size = new_file_size # set filesize to current file size
-                print('Some PA lines found and added.')
-                await asyncio.sleep(sleeptime)
+        run_ids = await run_stage(match_runs, directory, default=[], retry=(match_queue, [None]))
 
-            else:
-                print('PA file was the same size, so it was not touched.')
-                await asyncio.sleep(sleeptime)
+        if len(run_ids) != 0:
+            integrate_queue.put_nowait(run_ids)
+
+
+def correct_runs(directory, run_ids):
+    """
+    Makes any possible acetylene/n-butane corrections to the peaks of the given GcRuns (or every un-integrated
+    ambient or zero run if run_ids is None) with check_c4_rts(), commits them, and returns their ids. New runs are
+    already corrected by match_runs(), so this re-checks runs left un-integrated, ie at startup or when CRFs are
+    added.
+    """
+    print('Running correct_c4_rts()')
+    from reservoir_nmhc import connect_to_reservoir_db, GcRun, check_c4_rts, chunked, integrated_types
+
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory, write=True)
 
+    try:
+        if run_ids is None:
+            GcRuns = (session.query(GcRun)
+                      .filter(GcRun.data_id == None, GcRun.type.in_(integrated_types))
+                      .order_by(GcRun.id).all())  # standards etc. are never integrated, so never leave this set
         else:
-            print('PA file did not exist!')
-            print('PA file did not exist!')
-            await asyncio.sleep(sleeptime)
+            GcRuns = []
+            for chunk in chunked(sorted(run_ids)):
+                GcRuns.extend(session.query(GcRun).filter(GcRun.id.in_(chunk)).order_by(GcRun.id))
 
-        await asyncio.sleep(sleeptime)
-        session.close()
-        engine.dispose()
+        for run in GcRuns:
+            check_c4_rts(run)  # make any possible acetylene/nbutane corrections
 
+        session.commit()
 
-async def create_gc_runs(directory, sleeptime):
+        run_ids = [run.id for run in GcRuns]
+    except Exception:
+        rollback(session)
+        raise
+
+    session.close()
+
+    return run_ids
+
+
+async def correct_c4_rts(directory, c4_queue, integrate_queue):
+    """
+    Waits for GcRuns to re-check, corrects them with correct_runs(), and passes their ids on to integrate_runs().
+    A None event (at startup, or when CRFs are added) checks every un-integrated run, which is safe since
+    check_c4_rts() leaves already-corrected runs alone.
+    """
 
     while True:
-        print('Running create_gc_runs()')
-        from reservoir_nmhc import LogFile, NmhcLine, GcRun
-        from reservoir_nmhc import connect_to_reservoir_db
+        events = await drain_queue(c4_queue)
+
+        run_ids = await run_stage(correct_runs, directory, merge_events(events), default=[], retry=(c4_queue, events))
+
+        if len(run_ids) != 0:
+            integrate_queue.put_nowait(run_ids)
 
-        engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory)
-        Base.metadata.create_all(engine)
 
-        NmhcLines = (session.query(NmhcLine)
-                    .filter(NmhcLine.status == 'single')
-                    .order_by(NmhcLine.id).all())
+def update_crfs(directory):
+    """
+    Stores any new or revised CRFs from the CRF file, removes any no longer in it, and reintegrates the runs they
+    apply to. Returns whether any CRF periods were added or extended, and the ids of the reintegrated runs.
+    """
+    print('Running load_crfs()')
+    from reservoir_nmhc import read_crf_data, connect_to_reservoir_db, reintegrate_changed_crfs
+    from reservoir_nmhc import Crf
 
-        LogFiles = (session.query(LogFile)
-                    .filter(LogFile.status == 'single')
-                    .order_by(LogFile.id).all())
+    Crfs = read_crf_data(os.path.join(directory, 'reservoir_CRFs.txt'))
 
-        GcRuns = session.query(GcRun).order_by(GcRun.id).all()
-        run_dates = [run.date_end for run in GcRuns]
+    if Crfs is None:
+        return False, []
 
-        from reservoir_nmhc import match_log_to_pa
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory, write=True)
 
-        GcRuns = match_log_to_pa(LogFiles, NmhcLines)
+    try:
+        periods_before = set(session.query(Crf.date_start, Crf.date_end))
 
-        for run in GcRuns:
-            if run.date_end not in run_dates:
-                run_dates.append(run.date_end)
+        reintegrated = reintegrate_changed_crfs(session, Crfs)  # stores new/revised crfs, reintegrates their runs
 
-                from reservoir_nmhc import check_c4_rts
-                run = check_c4_rts(run)  # make any possible acetylene/nbutane corrections
+        if len(reintegrated) != 0:
+            print(f'{len(reintegrated)} runs were reintegrated after changes to the CRF file.')
+
+        added = len(set(session.query(Crf.date_start, Crf.date_end)) - periods_before) != 0  # any new periods
+        reintegrated = [run.id for run in reintegrated]
 
-                session.merge(run)
         session.commit()
+    except Exception:
+        rollback(session)
+        raise
 
-        session.close()
-        engine.dispose()
-        await asyncio.sleep(sleeptime)
+    session.close()
 
+    return added, reintegrated
 
-async def load_crfs(directory, sleeptime):
+
+async def load_crfs(directory, c4_queue, plot_queue, sleeptime):
+    """
+    Checks the CRF file every sleeptime seconds, and when it has changed, updates the CRFs with update_crfs().
+    Reintegrated runs are passed to plot_new_data(), and new CRFs have all un-integrated runs re-checked, since
+    runs that fell outside every CRF period may now be integrable.
+    """
+    crf_path = os.path.join(directory, 'reservoir_CRFs.txt')
+    crf_mtime = None
 
     while True:
-        print('Running load_crfs()')
-        from reservoir_nmhc import read_crf_data, Crf, connect_to_reservoir_db, TempDir
+        mtime = os.path.getmtime(crf_path) if os.path.isfile(crf_path) else None
 
-        engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory)
-        Base.metadata.create_all(engine)
+        if mtime is None or mtime == crf_mtime:
+            await asyncio.sleep(sleeptime)  # unchanged since it was last read
+            continue
 
-        with TempDir(homedir):
-            Crfs = read_crf_data('reservoir_CRFs.txt')
+        added, reintegrated = await run_stage(update_crfs, directory, default=(False, []))
 
-        Crfs_in_db = session.query(Crf).order_by(Crf.id).all()
-        crf_dates = [rf.date_start for rf in Crfs_in_db]
+        crf_mtime = mtime  # a file that failed to load isn't retried until it changes again
 
-        for rf in Crfs:
-            if rf.date_start not in crf_dates: # prevent duplicates in db
-                crf_dates.append(rf.date_start) # prevent duplicates in this load
-                session.merge(rf)
+        if added:
+            c4_queue.put_nowait(None)  # un-integrated runs may now have a crf
 
-        session.commit()
+        if len(reintegrated) != 0:
+            plot_queue.put_nowait(reintegrated)
 
-        session.close()
-        engine.dispose()
         await asyncio.sleep(sleeptime)
 
 
-async def integrate_runs(directory, sleeptime):
+def integrate(directory, run_ids):
+    """
+    Integrates any of the given GcRuns (or every un-integrated ambient or zero run if run_ids is None) that have
+    a CRF, commits their data and the MixingRatios and DailySummary rows made from them, and returns the
+    integrated runs' ids.
+    """
+    print('Running integrate_runs()')
     from datetime import datetime
+    from reservoir_nmhc import CrfIndex, integrate_batch, refresh_mixing_ratios, refresh_daily_summaries
+    from reservoir_nmhc import GcRun, Datum, Crf, chunked, integrated_types
 
-    while True:
-        print('Running integrate_runs()')
-        from reservoir_nmhc import find_crf
-        from reservoir_nmhc import GcRun, Datum, Crf
-
-        from reservoir_nmhc import connect_to_reservoir_db
+    from reservoir_nmhc import connect_to_reservoir_db
 
-        engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory)
-        Base.metadata.create_all(engine)
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory, write=True)
 
-        GcRuns = (session.query(GcRun)
-                .filter(GcRun.data_id == None)
-                .order_by(GcRun.id).all()) # get all un-integrated runs
+    try:
+        if run_ids is None:
+            GcRuns = (session.query(GcRun)
+                    .filter(GcRun.data_id == None, GcRun.type.in_(integrated_types))
+                    .order_by(GcRun.id).all()) # get all un-integrated runs that can be integrated
+        else:
+            GcRuns = []
+            for chunk in chunked(sorted(run_ids)):
+                GcRuns.extend(session.query(GcRun)
+                              .filter(GcRun.data_id == None, GcRun.type.in_(integrated_types))
+                              .filter(GcRun.id.in_(chunk))
+                              .order_by(GcRun.id))
 
-        Crfs = session.query(Crf).order_by(Crf.id).all() # get all crfs
+        crf_index = CrfIndex(session.query(Crf).all())  # index all crfs once for this cycle
 
-        data = [] # Match all runs with available CRFs
+        runs_in_gaps = [] # Match all runs with available CRFs
         for run in GcRuns:
-            run.crfs = find_crf(Crfs, run.date_end)
-            session.commit() # commit changes to crfs?
-            data.append(run.integrate())
+            run.crfs = crf_index.find(run.date_end)
+
+            if run.crfs is None:
+                runs_in_gaps.append(run)
+
+        data = [Datum(run) for run in integrate_batch(session, GcRuns)]  # integrate all runs in one pass
 
-        data_in_db = session.query(Datum).order_by(Datum.id).all()
-        data_dates = [d.date_end for d in data_in_db]
+        if len(runs_in_gaps) != 0:
+            print(f'{len(runs_in_gaps)} runs fell outside all CRF periods and could not be integrated, '
+                  + f'from {runs_in_gaps[0].date_end} to {runs_in_gaps[-1].date_end}.')
 
         if len(data) is 0:
             print(f'No data to integrate found at {datetime.now()}')
             session.commit()
             session.close()
-            engine.dispose()
-            await asyncio.sleep(sleeptime)
+            return []
 
-        else:
-            for datum in data:
-                if datum is not None and datum.date_end not in data_dates: # prevent duplicates in db
-                    data_dates.append(datum.date_end) # prevent duplicates on this load
-                    session.merge(datum)
-                    print(f'Data {datum} was added!')
+        for datum in data:  # only runs without data were integrated, so these can't be duplicates
+            session.add(datum)
+            print(f'Data {datum} was added!')
 
-            session.commit()
+        integrated = [datum.run_con.id for datum in data]
 
-            session.close()
-            engine.dispose()
-            await asyncio.sleep(sleeptime)
+        refresh_mixing_ratios(session, integrated)
+        refresh_daily_summaries(session, integrated)
+
+        session.commit()
+    except Exception:
+        rollback(session)
+        raise
+
+    session.close()
 
+    return integrated
 
-async def plot_new_data(directory, plotdir, sleeptime):
+
+async def integrate_runs(directory, integrate_queue, plot_queue):
     """
-    Date limits have been tinkered with to correctly plot provided data.
+    Waits for corrected GcRuns from create_gc_runs() or correct_c4_rts(), integrates them with integrate(), and
+    passes the ids of those that were integrated on to plot_new_data().
     """
 
-    days_to_plot = 3
-
     while True:
-        print('Running plot_new_data()')
-        data_len = 0
-        from reservoir_nmhc import connect_to_reservoir_db, TempDir, get_dates_mrs, res_nmhc_plot
-        from datetime import datetime
-        import datetime as dt
+        events = await drain_queue(integrate_queue)
+
+        integrated = await run_stage(integrate, directory, merge_events(events), default=[],
+                                     retry=(integrate_queue, events))
+
+        if len(integrated) != 0:
+            plot_queue.put_nowait(integrated)
 
-        engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory)
-        Base.metadata.create_all(engine)
 
-        # now = datetime.now()  # save 'now' as the start of making plots
-        # date_ago = now - dt.timedelta(days=days_to_plot+1)  # set a static limit for retrieving data at beginning of plot cycle
-        date_ago = datetime(2019,1,15)  #fake value for provided data
+def find_changed_plots(directory, plotdir):
+    """
+    Builds the spec of every plot, and returns (filename, fingerprint, spec) for each whose data, limits or ticks
+    changed since it was last rendered (per its PlotFingerprint), or whose file is missing. Returns None if there
+    was no data to plot.
+    """
+    print('Running plot_new_data()')
+    from reservoir_nmhc import connect_to_reservoir_db, get_wide_mrs, plot_windows
+    from reservoir_nmhc import PlotFingerprint, plot_fingerprint, plot_compounds, build_plot_specs
+    from datetime import datetime
+    import datetime as dt
 
-        date_limits = dict()
-        date_limits['right'] = datetime(2019, 1, 28).replace(hour=0, minute=0, second=0, microsecond=0) + dt.timedelta(days=1)  # end of last day
-        date_limits['left'] = date_limits['right'] - dt.timedelta(days=days_to_plot)
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory)
 
-        ## For use at runtime:
-        # date_limits['right'] = now.replace(hour=0, minute=0, second=0, microsecond=0) + dt.timedelta(days=1)  # end of last day
-        # date_limits['left'] = date_limits['right'] - dt.timedelta(days=days_to_plot)
+    # now = datetime.now()  # save 'now' as the start of making plots
+    # right = now.replace(hour=0, minute=0, second=0, microsecond=0) + dt.timedelta(days=1)  # end of last day
+    right = datetime(2019, 1, 28) + dt.timedelta(days=1)  # fake value for provided data; end of last day
 
-        major_ticks = [date_limits['right'] - dt.timedelta(days=x) for x in range(0, days_to_plot+1)]  # make dynamic ticks
-        minor_ticks = [date_limits['right'] - dt.timedelta(hours=x*6) for x in range(0, days_to_plot*4+1)]
+    widest = max(window['days'] for window in plot_windows)
+    date_ago = right - dt.timedelta(days=widest+1)  # one fetch covers every window
 
-        try:
-            _ , dates = get_dates_mrs(session, 'ethane', date_start=date_ago)  # get dates for data length
+    try:
+        dates, mrs = get_wide_mrs(session, plot_compounds(), date_start=date_ago)  # all series in one range scan
 
-        except ValueError:
-            print('No new data was found. Plots were not created.')
-            session.close()
-            engine.dispose()
-            await asyncio.sleep(sleeptime)
-            continue
+        fingerprints = {fp.filename: fp.fingerprint for fp in session.query(PlotFingerprint)}
+    except Exception:
+        rollback(session)
+        raise
 
-        if len(dates) != data_len:
-            with TempDir(plotdir): ## PLOT ethane and propane
-                ethane_mrs, ethane_dates = get_dates_mrs(session, 'ethane', date_start=date_ago)
-                propane_mrs, propane_dates = get_dates_mrs(session, 'propane', date_start=date_ago)
-                res_nmhc_plot(None, ({'Ethane': [ethane_dates, ethane_mrs],
-                                      'Propane': [propane_dates, propane_mrs]}),
-                              limits={'right': date_limits.get('right',None),
-                                      'left': date_limits.get('left', None),
-                                      'bottom': 0},
-                              major_ticks=major_ticks,
-                              minor_ticks=minor_ticks)
-
-            with TempDir(plotdir): ## PLOT i-butane, n-butane, acetylene
-                ibut_mrs, ibut_dates = get_dates_mrs(session, 'i-butane', date_start=date_ago)
-                nbut_mrs, nbut_dates = get_dates_mrs(session, 'n-butane', date_start=date_ago)
-                acet_mrs, acet_dates = get_dates_mrs(session, 'acetylene', date_start=date_ago)
-
-                res_nmhc_plot(None, ({'i-Butane': [ibut_dates, ibut_mrs],
-                                      'n-Butane': [nbut_dates, nbut_mrs],
-                                      'Acetylene': [acet_dates, acet_mrs]}),
-                              limits={'right': date_limits.get('right',None),
-                                      'left': date_limits.get('left', None),
-                                      'bottom': 0},
-                              major_ticks=major_ticks,
-                              minor_ticks=minor_ticks)
-
-            with TempDir(plotdir): ## PLOT i-pentane and n-pentane, & ratio
-                ipent_mrs, ipent_dates = get_dates_mrs(session, 'i-pentane', date_start=date_ago)
-                npent_mrs, npent_dates = get_dates_mrs(session, 'n-pentane', date_start=date_ago)
-
-                inpent_ratio = []
-
-                for i, n in zip(ipent_mrs, npent_mrs):
-                    if n == 0 or n == None:
-                        inpent_ratio.append(None)
-                    elif i == None:
-                        inpent_ratio.append(None)
-                    else:
-                        inpent_ratio.append(i/n)
-
-                res_nmhc_plot(dates, ({'i-Pentane': [ipent_dates, ipent_mrs],
-                                       'n-Pentane': [npent_dates, npent_mrs]}),
-                              limits={'right': date_limits.get('right',None),
-                                      'left': date_limits.get('left', None),
-                                      'bottom': 0},
-                              major_ticks=major_ticks,
-                              minor_ticks=minor_ticks)
-
-                res_nmhc_plot(None, ({'i/n Pentane ratio': [ipent_dates, inpent_ratio]}),
-                              limits={'right': date_limits.get('right',None),
-                                      'left': date_limits.get('left', None),
-                                      'bottom': 0,
-                                      'top': 3},
-                              major_ticks=major_ticks,
-                              minor_ticks=minor_ticks)
-
-            with TempDir(plotdir): ## PLOT benzene and toluene
-                benz_mrs, benz_dates = get_dates_mrs(session, 'benzene', date_start=date_ago)
-                tol_mrs, tol_dates = get_dates_mrs(session, 'toluene', date_start=date_ago)
-
-                res_nmhc_plot(None, ({'Benzene': [benz_dates, benz_mrs],
-                                      'Toluene': [tol_dates, tol_mrs]}),
-                              limits={'right': date_limits.get('right',None),
-                                      'left': date_limits.get('left', None),
-                                      'bottom': 0},
-                              major_ticks=major_ticks,
-                              minor_ticks=minor_ticks)
-
-            print('New data plots created!')
+    session.close()
 
-            session.close()
-            engine.dispose()
-            await asyncio.sleep(sleeptime)
-        else:
-            print('New data plots were not created, there was no new data.')
+    if len(dates) == 0:
+        return None
 
-            session.close()
-            engine.dispose()
-            await asyncio.sleep(sleeptime)
+    changed = []
+    for spec in build_plot_specs(dates, mrs, right):
+        filename = spec['filename']
+        fingerprint = plot_fingerprint(spec)
+
+        if fingerprints.get(filename) == fingerprint and os.path.isfile(os.path.join(plotdir, filename)):
+            continue  # unchanged since it was last rendered
+
+        changed.append((filename, fingerprint, spec))
+
+    return changed
+
+
+def store_plot_fingerprints(directory, rendered):
+    """
+    Stores the fingerprints of newly rendered plots.
+
+    rendered: list, of (filename, fingerprint) for each plot that was rendered
+    """
+    from reservoir_nmhc import connect_to_reservoir_db, PlotFingerprint
+    from datetime import datetime
+
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', directory, write=True)
+
+    try:
+        fingerprints = {fp.filename: fp for fp in session.query(PlotFingerprint)}
 
+        for filename, fingerprint in rendered:
+            if filename in fingerprints:
+                fingerprints[filename].fingerprint = fingerprint
+                fingerprints[filename].date = datetime.now()
+            else:
+                session.add(PlotFingerprint(filename, fingerprint, datetime.now()))
+
+        session.commit()
+    except Exception:
+        rollback(session)
+        raise
+
+    session.close()
+
+
+async def plot_new_data(directory, plotdir, plot_executor, plot_queue):
+    """
+    Date limits have been tinkered with to correctly plot provided data.
+
+    Waits for runs to be integrated or reintegrated, then updates the plots. Events that arrive while plots are
+    rendering are handled together in the next pass.
+
+    Every plot group in plot_groups is published for every window in plot_windows. The data for the widest
+    window are fetched once, and each window is sliced from them in memory.
+
+    Plots are rendered by render_plot in plot_executor, a ProcessPoolExecutor, so the event loop (and every other
+    stage) keeps running while they render, and independent plots render in parallel. Only plots whose data,
+    limits or ticks changed since they were last rendered (per their PlotFingerprint) are rendered again.
+    """
+    from reservoir_nmhc import render_plot
+
+    while True:
+        await drain_queue(plot_queue)  # the plots are made from the MixingRatios table, not the runs themselves
 
-os.chdir(homedir)
+        changed = await run_stage(find_changed_plots, directory, plotdir, default=[], retry=(plot_queue, [None]))
+
+        if changed is None:
+            print('No new data was found. Plots were not created.')
+            continue
 
-loop = asyncio.get_event_loop()
+        loop = asyncio.get_event_loop()
+        renders = [loop.run_in_executor(plot_executor, render_plot, plotdir, spec) for _, _, spec in changed]
 
-loop.create_task(check_load_logs(locallogdir, homedir, 5))
-loop.create_task(check_load_pas('NMHC_PA.LOG', homedir, 5))
-loop.create_task(create_gc_runs(homedir, 5))
-loop.create_task(load_crfs(homedir, 5))
-loop.create_task(integrate_runs(homedir, 5))
-loop.create_task(plot_new_data(homedir, plotdir, 5))
+        results = await asyncio.gather(*renders, return_exceptions=True)
+        # render all changed plots in parallel without blocking the loop
 
-loop.run_forever()
+        rendered = []
+        for (filename, fingerprint, _), result in zip(changed, results):
+            if isinstance(result, Exception):
+                print(f'Plot {filename} failed to render: {result}')
+            else:
+                rendered.append((filename, fingerprint))
+
+        if len(rendered) != 0:
+            await run_stage(store_plot_fingerprints, directory, rendered, retry=(plot_queue, [None]))
+
+        if len(changed) == 0:
+            print('New data plots were not created, there was no new data.')
+        else:
+            print(f'{len(rendered)} new data plots created!')
+
+
+if __name__ == '__main__':
+    # guarded so worker processes that import this module don't start their own loops
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from reservoir_nmhc import get_reservoir_engine, init_plot_worker
+
+    os.chdir(homedir)
+
+    logpath = os.path.join(homedir, locallogdir)
+    plotpath = os.path.join(homedir, plotdir)  # absolute, so no stage depends on the working directory
+
+    get_reservoir_engine('sqlite:///reservoir.sqlite', homedir)  # create the shared engine and schema once at startup
+
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    plot_executor = ProcessPoolExecutor(max_workers=4, initializer=init_plot_worker,
+                                        mp_context=multiprocessing.get_context(start_method))
+    # workers are started after the stages' threads hold SQLite connections and locks, which a forked worker
+    # would inherit mid-use, so they're started from a clean process instead
+
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=4))  # bounds the db and file work run by run_blocking
+
+    # each stage waits on its queue and publishes what it produced to the next:
+    # files -> logs/pas -> match and C4 correction -> integrate -> plot, with CRF changes re-checking
+    # un-integrated runs through correct_c4_rts and feeding plot
+    new_logs_queue = asyncio.Queue()
+    pa_changes_queue = asyncio.Queue()
+    match_queue = asyncio.Queue()
+    c4_queue = asyncio.Queue()
+    integrate_queue = asyncio.Queue()
+    plot_queue = asyncio.Queue()
+
+    for queue in (match_queue, c4_queue, plot_queue):
+        queue.put_nowait(None)  # pick up anything left pending by the last shutdown
+
+    tasks = [  # keep references, since the loop only holds weak references to its tasks
+        loop.create_task(watch_files(logpath, 'NMHC_PA.LOG', homedir, new_logs_queue, pa_changes_queue, 5)),
+        loop.create_task(check_load_logs(logpath, homedir, new_logs_queue, match_queue)),
+        loop.create_task(check_load_pas('NMHC_PA.LOG', homedir, pa_changes_queue, match_queue)),
+        loop.create_task(create_gc_runs(homedir, match_queue, integrate_queue)),
+        loop.create_task(correct_c4_rts(homedir, c4_queue, integrate_queue)),
+        loop.create_task(load_crfs(homedir, c4_queue, plot_queue, 5)),
+        loop.create_task(integrate_runs(homedir, integrate_queue, plot_queue)),
+        loop.create_task(plot_new_data(homedir, plotpath, plot_executor, plot_queue)),
+    ]
+
+    for task in tasks:
+        task.add_done_callback(report_stage_exit)
+
+    loop.run_forever()
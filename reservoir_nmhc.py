@@ -1,5 +1,6 @@
 import os
 import json
+import threading
 import datetime as dt
 from datetime import datetime
 
@@ -7,7 +8,7 @@ from sqlalchemy.types import TypeDecorator, VARCHAR
 from sqlalchemy.ext.mutable import MutableDict, MutableList
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Index, event
 from sqlalchemy.orm import relationship
 
 
@@ -60,19 +61,99 @@ log_params_list = (['filename', 'sampletime', 'sampleflow1', 'sampleflow2',
 
 gcrun_params_list = log_params_list + ['peaks', 'date_end', 'date_start', 'crfs', 'type']
 
+log_date_label = '<sample code>'
+# stands in for the label of the line whose label is the sample code itself, ie '2019028070527'
+
+log_format_shared = ([('Sample Time (s)', 'sampletime'), ('Sample Flow (V)', 'sampleflow1'),
+                      ('Sample Type', 'sampletype'), ('Backflush Time (s)', 'backflushtime'),
+                      ('Desorb Temp', 'desorbtemp'), ('Flash Heat Time (s)', 'flashheattime'),
+                      ('Inject Time (s)', 'injecttime'), ('Bakeout Temp', 'bakeouttemp'),
+                      ('Bakeout Time (s)', 'bakeouttime'), ('Carrier Flow SP (V)', 'carrierflow'),
+                      ('', None), ('Current Sample #', 'samplenum'), ('Sample P (psi)', 'samplepressure1'),
+                      ('GC Head P (psi)', 'GCHeadP'), ('WT T @ sample start', 'WT_temp_start'),
+                      ('Ads Trap T @ sample start', 'ads_temp_start'), ('', None), (log_date_label, 'samplecode'),
+                      ('Sample P (psi)', 'samplepressure2'), ('Sample Flow (V)', 'sampleflow2'),
+                      ('WT T @ sample end', 'WT_temp_end'), ('Ads Trap T @ sample end', 'ads_temp_end'),
+                      ('', None), ('Trap Temp @ FH', 'traptempFH'), ('GC Start Temp', 'GCstarttemp'),
+                      ('Trap Temp @ inject end', 'traptempinject_end')])
+# (label, LogFile attribute) of the lines every log version starts with; blank labels are unused lines
+
+log_formats = ({1: log_format_shared + [('Trap Temp @ bakeout end', 'traptempbakeout_end'),
+                                        ('WT Hot Temp', 'wthottemp'), ('GC Head P1 (psi)', 'GCHeadP1'),
+                                        ('GC Oven T', 'GCoventemp')],
+                2: log_format_shared + [('Battery V @ inject end', 'battvinject_end'),
+                                        ('Trap Heat Out @ inject end', 'trapheatoutinject_end'),
+                                        ('Trap Temp @ bakeout end', 'traptempbakeout_end'),
+                                        ('Battery V @ bakeout end', 'battvbakeout_end'),
+                                        ('Trap Heat Out @ bakeout end', 'trapheatoutbakeout_end'),
+                                        ('WT Hot Temp', 'wthottemp'), ('GC Head P1 (psi)', 'GCHeadP1'),
+                                        ('GC Oven T', 'GCoventemp')]})
+# every known version of the LabView log, as its lines in order; 1 is the early 30-line log, 2 the 34-line log
+
+
+def compile_log_format(lines):
+    """
+    Turns a log format's (label, attribute) lines into a dict of {(label, occurrence): attribute}, so repeated
+    labels (ie the two 'Sample P (psi)' lines) are told apart by how many times the label has appeared before.
+    """
+    fields = dict()
+    occurrences = dict()
+
+    for label, attr in lines:
+        occurrence = occurrences.get(label, 0)
+        occurrences[label] = occurrence + 1
+        fields[(label, occurrence)] = attr
+
+    return fields
+
+
+log_format_fields = {version: compile_log_format(lines) for version, lines in log_formats.items()}
+# compiled once, largest (newest) version first, since a version is chosen by the first that has all its labels
+log_format_fields = dict(sorted(log_format_fields.items(), key=lambda item: len(item[1]), reverse=True))
+
+log_int_fields = {'sampletype', 'samplenum'}  # log attributes that are stored as ints
+
 sample_types = {0:'zero', 1:'alt_standard', 2:'standard', 3:'alt_not_sure', 5:'ambient'}
 # dict of all sample numbers and corresponding type names
 
+integrated_types = ['ambient', 'zero']  # sample types that GcRun.integrate() gives mixing ratios for
+
+summary_types = ['ambient', 'zero']  # sample types kept in the DailySummary table
+
 compound_list = ['ethane','ethene','propane','propene','i-butane','acetylene',
                 'n-butane','i-pentane','n-pentane','hexane','isoprene','benzene',
                 'toluene','ethyl-benzene','m&p xylene','o-xylene']  # list of all quantified compounds
 
+compound_columns = {compound: compound.replace('&', '').replace('-', '_').replace(' ', '_')
+                    for compound in compound_list}  # attribute/column-safe names, ie 'm&p xylene': 'mp_xylene'
+
 compound_ecns = ({'ethane': 2, 'ethene': 1.9, 'propane': 3, 'propene': 2.9,
                 'i-butane': 4, 'acetylene': 1.8, 'n-butane': 4, 'i-pentane': 5,
                 'n-pentane': 5, 'hexane': 6, 'isoprene': 4.8, 'benzene': 5.7,
                 'toluene': 6.7, 'ethyl-benzene': 7.7, 'm&p xylene': 7.7,
                 'o-xylene': 7.7}) # expected carbon numbers for mixing ratio calcs
 
+# plot groups to publish; each maps legend names to a compound, or to a (numerator, denominator) pair for a ratio
+# 'limits' are any axis limits beyond the defaults (bottom of 0, left and right from the window)
+plot_groups = ([{'compounds': {'Ethane': 'ethane', 'Propane': 'propane'}},
+                {'compounds': {'i-Butane': 'i-butane', 'n-Butane': 'n-butane', 'Acetylene': 'acetylene'}},
+                {'compounds': {'i-Pentane': 'i-pentane', 'n-Pentane': 'n-pentane'}},
+                {'compounds': {'i/n Pentane ratio': ('i-pentane', 'n-pentane')}, 'limits': {'top': 3}},
+                {'compounds': {'Benzene': 'benzene', 'Toluene': 'toluene'}}])
+
+# time windows every plot group is published for, with tick spacing counted back from the right edge
+# 'max_points' downsamples each line with lttb so long windows render in constant time
+# 'last_week' is the filename the website has always linked to, so it's kept for the 7-day window
+plot_windows = ([{'suffix': 'last_3_days', 'days': 3,
+                  'major_ticks': dt.timedelta(days=1), 'minor_ticks': dt.timedelta(hours=6)},
+                 {'suffix': 'last_week', 'days': 7,
+                  'major_ticks': dt.timedelta(days=1), 'minor_ticks': dt.timedelta(hours=6)},
+                 {'suffix': 'last_month', 'days': 30, 'max_points': 1000,
+                  'major_ticks': dt.timedelta(days=7), 'minor_ticks': dt.timedelta(days=1)},
+                 {'suffix': 'last_year', 'days': 365, 'max_points': 1000,
+                  'major_ticks': dt.timedelta(days=60), 'minor_ticks': dt.timedelta(days=10)}])
+
+
 class Crf(Base):
     """
     A crf is a set of carbon response factors for compounds, tied to a datetime and standard.
@@ -100,7 +181,7 @@ class Crf(Base):
     def __init__(self, date_start, date_end, date_revision, compounds, standard):
         self.date_start = date_start
         self.date_end = date_end
-        self.date_revision = date_revision
+        self.revision_date = date_revision  # stored in the revision_date column
         self.standard = standard
         self.compounds = compounds # assign whole dict of CRFs
 
@@ -111,6 +192,126 @@ class Crf(Base):
         return f'<crf {self.standard} for {self.date_start} to {self.date_end}>'
 
 
+class FileCheckpoint(Base):
+    """
+    A persisted read position in a file that is only ever appended to, like NMHC_PA.LOG. Storing it in the
+    database lets a restarted process pick up where it left off instead of re-reading the whole file.
+
+    filename: str, the name of the file being read
+    offset: int, byte offset of the first unread byte; always the start of a line
+    inode: int, inode of the file when it was last read; a change means the file was replaced
+    size: int, size of the file in bytes when it was last read
+    """
+
+    __tablename__ = 'checkpoints'
+
+    id = Column(Integer, primary_key = True)
+    filename = Column(String, unique = True)
+    offset = Column(Integer)
+    inode = Column(Integer)
+    size = Column(Integer)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0  # all checkpoints begin at the start of the file
+        self.inode = None
+        self.size = 0
+
+    def __str__(self):
+        return f'<checkpoint for {self.filename} at byte {self.offset}>'
+
+    def __repr__(self):
+        return f'<checkpoint for {self.filename} at byte {self.offset}>'
+
+
+class PeakIndexMixin():
+    """
+    Cached lookups of a run's peaks (self.peaks) by name and by retention time, shared by GcRun, Datum and
+    RunRecord, so get_mr/get_pa/get_rt and check_c4_rts don't scan every peak for every lookup.
+
+    Each peak keeps a list of the runs that have indexed it. Renaming a peak drops the name index of only those
+    runs, setting its rt drops their rt view, and removing it from an NmhcLine drops both (see the Peak and
+    PeakRecord setters and the events below them). Both are also rebuilt if the run's peak list is replaced or
+    changes length.
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def peak_changed(peak, caches=('_peak_name_cache', '_peak_rt_cache', '_watched_peaks')):
+        """Drops the given caches of every run that has indexed peak; by default all of them."""
+        for run in getattr(peak, '_index_owners', None) or ():
+            for cache in caches:
+                setattr(run, cache, None)
+
+    def watch_peaks(self, peaks):
+        """
+        Records this run on each of its peaks, so a change to one of them drops this run's caches. Each peak list
+        is only walked once per run; if a peak is removed from it, its runs walk their lists again.
+        """
+        key = (id(peaks), len(peaks))
+        if getattr(self, '_watched_peaks', None) == key:
+            return
+
+        for peak in peaks:
+            owners = getattr(peak, '_index_owners', None)
+            if owners is None:
+                peak._index_owners = [self]
+            elif self not in owners:
+                owners.append(self)
+
+        self._watched_peaks = key
+
+    def peak_index(self):
+        """Returns {name: peak} for this run's peaks, with the first peak of any repeated name."""
+        peaks = self.peaks
+        key = (id(peaks), len(peaks))
+
+        cache = getattr(self, '_peak_name_cache', None)
+        if cache is None or cache[0] != key:
+            cache = (key, {peak.name: peak for peak in reversed(peaks)})  # reversed, so the first of a name wins
+            self._peak_name_cache = cache
+            self.watch_peaks(peaks)
+
+        return cache[1]
+
+    def peaks_near_rt(self, rt, low, high):
+        """
+        Returns the peaks whose retention time is between low and high (exclusive) after rt, ie those with
+        low < (peak.rt - rt) < high, in their order in the run. Found by bisecting an rt-sorted view of the peaks.
+        """
+        from bisect import bisect_left, bisect_right
+
+        peaks = self.peaks
+        key = (id(peaks), len(peaks))
+
+        cache = getattr(self, '_peak_rt_cache', None)
+        if cache is None or cache[0] != key:
+            positions = [position for position, peak in enumerate(peaks) if peak.rt is not None]
+            positions.sort(key=lambda position: peaks[position].rt)  # stable, so equal rts stay in run order
+            cache = (key, [peaks[position].rt for position in positions], positions)
+            self._peak_rt_cache = cache
+            self.watch_peaks(peaks)
+
+        _, rts, positions = cache
+
+        margin = 1e-9  # bisect a little wide, then apply the exact test, so float rounding can't change the result
+        candidates = sorted(positions[bisect_left(rts, rt + low - margin):bisect_right(rts, rt + high + margin)])
+
+        return [peaks[position] for position in candidates if low < (peaks[position].rt - rt) < high]
+
+    def get_mr(self, compound_name):
+        peak = self.peak_index().get(compound_name)
+        return peak.mr if peak is not None else None
+
+    def get_pa(self, compound_name):
+        peak = self.peak_index().get(compound_name)
+        return peak.pa if peak is not None else None
+
+    def get_rt(self, compound_name):
+        peak = self.peak_index().get(compound_name)
+        return peak.rt if peak is not None else None
+
+
 class Peak(Base):
     """
     A peak is just that, a signal peak in PeakSimple, Agilent, or another
@@ -180,6 +381,16 @@ class Peak(Base):
         self.mr = mr
 
 
+@event.listens_for(Peak.name, 'set')
+def peak_renamed(target, value, oldvalue, initiator):
+    PeakIndexMixin.peak_changed(target, ('_peak_name_cache',))
+
+
+@event.listens_for(Peak.rt, 'set')
+def peak_moved(target, value, oldvalue, initiator):
+    PeakIndexMixin.peak_changed(target, ('_peak_rt_cache',))
+
+
 class NmhcLine(Base):
     """
     A line in NMHC_PA.LOG, which contains a datetime and some set of peaks.
@@ -220,6 +431,11 @@ class NmhcLine(Base):
         return f'<NmhcLine for {iso}>'
 
 
+@event.listens_for(NmhcLine.peaklist, 'remove')
+def peak_removed(target, value, initiator):
+    PeakIndexMixin.peak_changed(value)  # a peak replaced in place doesn't change the list's length
+
+
 class NmhcCorrection(NmhcLine):
     """
     A subclass of NmhcLine, this is linked to one NmhcLine, and is tied to a new table. All corrections are therefore
@@ -389,7 +605,7 @@ class LogFile(Base):
         return f'<{self.status} log {self.filename} at {iso}>'
 
 
-class GcRun(Base):
+class GcRun(PeakIndexMixin, Base):
     """
     A run, which consists of the attributes taken from the NmhcLine and LogFile
     that are used to create it. This is now a confirmed run, meaning it was executed
@@ -448,15 +664,6 @@ class GcRun(Base):
     def _repr__(self):
         return f'<matched gc run at {self.date_end}>'
 
-    def get_mr(self, compound_name):
-        return next((peak.mr for peak in self.peaks if peak.name == compound_name), None)
-
-    def get_pa(self, compound_name):
-        return next((peak.pa for peak in self.peaks if peak.name == compound_name), None)
-
-    def get_rt(self, compound_name):
-        return next((peak.rt for peak in self.peaks if peak.name == compound_name), None)
-
     def get_unnamed_peaks(self):
         # returns list of unidentified peaks in a run
         return [peak for peak in self.peaks if peak.name == '-']
@@ -485,7 +692,7 @@ class GcRun(Base):
             return None  # don't integrate if it's not an ambient or blank sample
 
 
-class Datum(Base):
+class Datum(PeakIndexMixin, Base):
     """
     A point of the plural data. This is a gc run that has been integrated, has a
     mixing ratio (which can be None if it is a failed or QC removed run -- that we
@@ -530,353 +737,1934 @@ class Datum(Base):
     # GET Methods for all embedded objects of a datum
     # These are resource-expensive, but can be used for one-offs where queries are unnecesary or tedious
 
-    def get_mr(self, compound_name):
-        return next((peak.mr for peak in self.peaks if peak.name == compound_name), None)
-
-    def get_pa(self, compound_name):
-        return next((peak.pa for peak in self.peaks if peak.name == compound_name), None)
-
-    def get_rt(self, compound_name):
-        return next((peak.rt for peak in self.peaks if peak.name == compound_name), None)
-
     def get_crf(self, compound_name):
         return self.crfs.compounds.get(compound_name, None)
 
 
-def find_crf(crfs, sample_date):
+class MixingRatios(Base):
     """
-    Returns the carbon response factor object for a sample at the given sample_date
-
-    crfs: list, of crf objects
-    sample_date: datetime, the date_start attribute of a sample
+    A materialized, wide copy of the mixing ratios of each integrated run, with one column per compound in
+    compound_list (named as in compound_columns). It's keyed by the run's date, so reading a time series is a
+    range scan of one table rather than a join through every peak. Rows are kept up to date by
+    refresh_mixing_ratios() whenever runs are integrated or reintegrated.
+
+    date: datetime, the date of the run's LogFile (start of the sampling window), as used for plotting
+    date_end: datetime, the date of the run's NmhcLine
+    run_id: int, id of the GcRun
+    data_id: int, id of the run's Datum
+    type: str, the run type, ie 'ambient' or 'zero'
+    qc: int, the Datum's qc status
+    {compound column}: float, the mixing ratio of that compound, or None
     """
 
-    return next((crf for crf in crfs if crf.date_start <= sample_date < crf.date_end), None)
-
+    __tablename__ = 'mixing_ratios'
 
-def read_crf_data(filename):
+    date = Column(DateTime, primary_key = True)
+    date_end = Column(DateTime)
+    run_id = Column(Integer, ForeignKey('gcruns.id'), unique = True)
+    data_id = Column(Integer, ForeignKey('data.id'))
+    type = Column(String)
+    qc = Column(Integer)
 
-    try:
-        lines = open(filename).readlines()
-    except FileNotFoundError:
-        print('CRF File not found. No runs can be integrated.')
-        return
+    for compound in compound_list:
+        vars()[compound_columns[compound]] = Column(Float)  # one column per compound
 
-    compounds = dict()
+    def __str__(self):
+        return f'<mixing ratios for {self.type} run at {self.date}>'
 
-    keys = lines[0].split('\t')[3:] #list of strs of all compound names from file
+    def __repr__(self):
+        return f'<mixing ratios for {self.type} run at {self.date}>'
 
-    Crfs = []
+    def get_mr(self, compound_name):
+        return getattr(self, compound_columns[compound_name], None)
 
-    for line in lines[1:]:
-        ls = line.split('\t')
-        date_start = datetime.strptime(ls[0], '%m/%d/%Y %H:%M')
-        date_end = datetime.strptime(ls[1], '%m/%d/%Y %H:%M')
-        date_revision = datetime.strptime(ls[2], '%m/%d/%Y %H:%M')
 
-        for index, (key, rf) in enumerate(zip(keys,ls[3:])):
-            key = key.strip().lower()
-            #unpack all names from header as keys and line items as values
-            compounds[key] = float(rf)
+class PlotFingerprint(Base):
+    """
+    The fingerprint (see plot_fingerprint) of the data a plot was last rendered from, persisted so plots whose
+    data haven't changed aren't rendered again, even after a restart.
 
-        if date_start is not None and date_end is not None:
-            Crfs.append(Crf(date_start, date_end, date_revision, compounds, 'working standard'))
+    filename: str, the plot's filename, ie 'ethane_propane_last_week.png'
+    fingerprint: str, hash of the data, limits and ticks it was rendered with
+    date: datetime, when it was last rendered
+    """
 
-    return Crfs
+    __tablename__ = 'plot_fingerprints'
 
+    id = Column(Integer, primary_key = True)
+    filename = Column(String, unique = True)
+    fingerprint = Column(String)
+    date = Column(DateTime)
 
-def read_log_file(filename):
-    with open(filename) as file:
-        contents = file.readlines()
+    def __init__(self, filename, fingerprint, date):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.date = date
 
-        log_dict = dict()
+    def __str__(self):
+        return f'<fingerprint for {self.filename} rendered at {self.date}>'
 
-        # There are different log file versions
-            # These are the parameters shared by both, assign these, then assign
-            # others based on file length
-        try:
-            log_dict['filename'] = file.name
-            log_dict['date'] = datetime.strptime(contents[17].split('\t')[0], '%Y%j%H%M%S')
-            log_dict['sampletime'] = float(contents[0].split('\t')[1])
-            log_dict['sampleflow1'] = float(contents[1].split('\t')[1])
-            log_dict['sampleflow2'] = float(contents[19].split('\t')[1])
-            log_dict['sampletype'] = int(float(contents[2].split('\t')[1]))
-            log_dict['backflushtime'] = float(contents[3].split('\t')[1])
-            log_dict['desorbtemp'] = float(contents[4].split('\t')[1])
-            log_dict['flashheattime'] = float(contents[5].split('\t')[1])
-            log_dict['injecttime'] = float(contents[6].split('\t')[1])
-            log_dict['bakeouttemp'] = float(contents[7].split('\t')[1])
-            log_dict['bakeouttime'] = float(contents[8].split('\t')[1])
-            log_dict['carrierflow'] = float(contents[9].split('\t')[1])
-            log_dict['samplenum'] = int(float(contents[11].split('\t')[1]))
-            log_dict['samplepressure1'] = float(contents[12].split('\t')[1])
-            log_dict['samplepressure2'] = float(contents[18].split('\t')[1])
-            log_dict['GCHeadP'] = float(contents[13].split('\t')[1])
-            log_dict['WT_temp_start'] = float(contents[14].split('\t')[1])
-            log_dict['ads_temp_start'] = float(contents[15].split('\t')[1])
-            log_dict['samplecode'] = int(contents[17].split('\t')[0])
-            log_dict['WT_temp_end'] = float(contents[20].split('\t')[1])
-            log_dict['ads_temp_end'] = float(contents[21].split('\t')[1])
-            log_dict['traptempFH'] = float(contents[23].split('\t')[1])
-            log_dict['GCstarttemp'] = float(contents[24].split('\t')[1])
-            log_dict['traptempinject_end'] = float(contents[26].split('\t')[1])
-
-            if len(contents) == 30:
-                # Early versions of the log files don't contain specific lines
-                    # Don't include those missing values
-
-                log_dict['traptempbakeout_end'] = float(contents[26].split('\t')[1])
-                log_dict['wthottemp'] = float(contents[27].split('\t')[1])
-                log_dict['GCHeadP1'] = float(contents[28].split('\t')[1])
-                log_dict['GCoventemp'] = float(contents[29].split('\t')[1])
-
-                return LogFile(log_dict)
-
-            elif len(contents) == 34:
-
-                log_dict['battvinject_end'] = float(contents[26].split('\t')[1])
-                log_dict['trapheatoutinject_end'] = float(contents[27].split('\t')[1])
-                log_dict['traptempbakeout_end'] = float(contents[28].split('\t')[1])
-                log_dict['battvbakeout_end'] = float(contents[29].split('\t')[1])
-                log_dict['trapheatoutbakeout_end'] = float(contents[30].split('\t')[1])
-                log_dict['wthottemp'] = float(contents[31].split('\t')[1])
-                log_dict['GCHeadP1'] = float(contents[32].split('\t')[1])
-                log_dict['GCoventemp'] = float(contents[33].split('\t')[1])
-
-                return LogFile(log_dict)
-            else:
-                print(f'File {file.name} had an improper number of lines and was ignored.')
-                return None
-        except:
-            print(f'File {file.name} failed to be processed and was ignored.')
-            return None
+    def __repr__(self):
+        return f'<fingerprint for {self.filename} rendered at {self.date}>'
 
-def read_pa_line(line):
 
+class DailySummary(Base):
     """
-    read_pa_line takes one line as a str from the NMHC_PA.LOG file, and parses it
-        into an NmhcLine object
-
-    line: str, a line from NMHC_PA.LOG
+    Summary statistics of one compound's mixing ratios over one day of one sample type, kept up to date from the
+    MixingRatios table by refresh_daily_summaries() whenever runs are integrated or reintegrated. The sums allow
+    means and standard deviations of any longer period to be rolled up without reading the runs themselves.
+
+    date: date, the day summarized (by the runs' LogFile dates)
+    compound: str, the compound name, ie 'ethane'
+    type: str, the sample type, one of summary_types
+    count: int, the number of runs with a mixing ratio for the compound
+    sum: float, the sum of those mixing ratios
+    sumsq: float, the sum of their squares
+    min: float, the smallest of them
+    max: float, the largest of them
     """
 
-    ls = line.split('\t')
-    line_peaks = []
+    __tablename__ = 'daily_summaries'
 
-    line_date = datetime.strptime(ls[1] + ' ' + ls[2], '%m/%d/%Y %H:%M:%S')
+    date = Column(Date, primary_key = True)
+    compound = Column(String, primary_key = True)
+    type = Column(String, primary_key = True)
+    count = Column(Integer)
+    sum = Column(Float)
+    sumsq = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
 
-    for ind, item in enumerate(ls[3:]):
+    def __str__(self):
+        return f'<{self.type} summary of {self.compound} on {self.date}>'
 
-        ind = ind+3 # offset ind since we're working with ls[3:]
+    def __repr__(self):
+        return f'<{self.type} summary of {self.compound} on {self.date}>'
 
-        peak_dict = dict()
 
-        if '"' in item:
+# Secondary indexes on the columns that are filtered and joined on every cycle. These are declared outside the
+# classes so NmhcCorrection doesn't inherit NmhcLine's. Existing dbs get them from migrate_reservoir_db().
+Index('ix_peaks_name_line_id', Peak.__table__.c.name, Peak.__table__.c.line_id)  # compound series by name
+Index('ix_peaks_line_id', Peak.__table__.c.line_id)  # all peaks of a line
+Index('ix_logfiles_status_date', LogFile.__table__.c.status, LogFile.__table__.c.date)  # single logs
+Index('ix_logfiles_filename', LogFile.__table__.c.filename)  # checking for already-loaded files
+Index('ix_nmhclines_status_date', NmhcLine.__table__.c.status, NmhcLine.__table__.c.date)  # single lines
+Index('ix_gcruns_data_id', GcRun.__table__.c.data_id)  # un-integrated runs
+Index('ix_gcruns_nmhcline_id', GcRun.__table__.c.nmhcline_id)  # joins from lines and peaks to runs
 
-            peak_dict['name'] = item.strip('"') # can't fail, " is definitely there
 
-            try:
-                peak_dict['rt'] = float(ls[ind+1])
-            except:
-                peak_dict['rt'] = None
-            try:
-                peak_dict['pa'] = float(ls[ind+2])
-            except:
-                peak_dict['pa'] = None
+class LogRecord():
+    """
+    A lightweight stand-in for LogFile, with the same attributes but none of SQLAlchemy's instrumentation, for
+    parsing and matching many logs at once. Written to the db by bulk_insert_logs/bulk_insert_runs.
 
-            if None not in peak_dict.values():
-                line_peaks.append(Peak(peak_dict['name'], peak_dict['pa'], peak_dict['rt']))
+    id: int, the logfiles id if it was loaded from the db, otherwise None
+    See LogFile for the rest.
+    """
+    __slots__ = ['id', 'date', 'status'] + log_params_list
 
-    if len(line_peaks) == 0:
-        this_line = None
-    else:
-        this_line = NmhcLine(line_date, line_peaks)
+    def __init__(self, param_dict):
+        for attr in log_params_list:
+            setattr(self, attr, param_dict.get(attr, None))
 
-    return this_line
+        self.id = param_dict.get('id', None)
+        self.date = param_dict.get('date', None)
+        self.status = param_dict.get('status', 'single')
+
+    def __str__(self):
+        return f'<{self.status} log record {self.filename} at {self.date}>'
+
+    def __repr__(self):
+        return f'<{self.status} log record {self.filename} at {self.date}>'
 
 
-def find_closest_date(date, list_of_dates):
+class PeakRecord():
     """
-    This is a helper function that works on Python datetimes. It returns the closest date value,
-    and the timedelta from the provided date.
+    A lightweight stand-in for Peak. Renaming a record's peak (ie in check_c4_rts) marks it as renamed, so only
+    changed names are written back by bulk_insert_runs. Renaming it or setting its rt drops the caches of the runs
+    that indexed it, as it does for a Peak.
+
+    id: int, the peaks id if it was loaded from the db, otherwise None
+    renamed: bool, whether name was changed after the record was made
+    See Peak for the rest.
     """
-    match = min(list_of_dates, key = lambda x: abs(x - date))
-    delta = match - date
+    __slots__ = ['id', '_name', 'pa', 'mr', '_rt', 'rev', 'qc', 'renamed', '_index_owners']
 
-    return match, delta
+    def __init__(self, name, pa, rt, id=None, mr=None, rev=0, qc=0):
+        self.id = id
+        self._name = name.lower()
+        self.pa = pa
+        self.mr = mr
+        self._rt = rt
+        self.rev = rev
+        self.qc = qc
+        self.renamed = False
+        self._index_owners = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self.renamed = True
+        PeakIndexMixin.peak_changed(self, ('_peak_name_cache',))
+
+    @property
+    def rt(self):
+        return self._rt
+
+    @rt.setter
+    def rt(self, rt):
+        self._rt = rt
+        PeakIndexMixin.peak_changed(self, ('_peak_rt_cache',))
 
+    def __str__(self):
+        return f'<peak record {self.name} with pa {self.pa} and rt {self.rt}>'
 
-def search_for_attr_value(obj_list, attr, value):
-    """
-    Finds the first (not necesarilly the only) object in a list, where its
-    attribute 'attr' is equal to 'value', returns None if none is found.
-    """
-    return next((obj for obj in obj_list if getattr(obj,attr, None) == value), None)
+    def __repr__(self):
+        return f'<peak record {self.name} with pa {self.pa} and rt {self.rt}>'
 
 
-def match_log_to_pa(LogFiles, NmhcLines):
+class PaLineRecord():
     """
-    This takes a list of LogFile and NmhcLine objects and returns a list (empty, even)
-        of resulting GcRun objects. When matching objects, it WILL modify their parameters
-        and status if warranted.
-    LogFiles: list (of LogFile objects), any log files that need partners
-    NmhcLines: list (of NmhcLine objects), any NmhcLine objects that could be matched
+    A lightweight stand-in for NmhcLine.
 
+    id: int, the nmhclines id if it was loaded from the db, otherwise None
+    date: datetime, the date PeakSimple recorded the line
+    peaklist: list, of PeakRecords
+    status: str, 'single' or 'married'
     """
+    __slots__ = ['id', 'date', 'peaklist', 'status']
 
-    runs = []
+    def __init__(self, date, peaks, id=None, status='single'):
+        self.id = id
+        self.date = date
+        self.peaklist = peaks
+        self.status = status
 
-    for log in LogFiles:
-        # For each log, attempt to find matching NmhcLine
-        # unpack date attr from all NmhcLines provided
-        nmhc_dates = [line.date for line in NmhcLines]
+    def __str__(self):
+        return f'<{self.status} line record at {self.date}>'
 
-        [match, diff] = find_closest_date(log.date, nmhc_dates) # get matching date and it's difference
+    def __repr__(self):
+        return f'<{self.status} line record at {self.date}>'
 
-        if abs(diff) < dt.timedelta(minutes=11):
-            # Valid match
-            matched_line = search_for_attr_value(NmhcLines,'date', match) # pull matching NmhcLine
 
-            runs.append(GcRun(log, matched_line))
-            log.status = 'married'
-            matched_line.status = 'married'
-        else:
-            continue
+class RunRecord(PeakIndexMixin):
+    """
+    A lightweight stand-in for GcRun that pairs a LogRecord and a PaLineRecord, for matching and correcting
+    many runs at once (see match_log_to_pa's run_factory and check_c4_rts) before writing them with
+    bulk_insert_runs. Log parameters are read through from the log, as GcRun's association proxies do.
+    """
+    __slots__ = ['log_con', 'nmhc_con', 'type', '_peak_name_cache', '_peak_rt_cache', '_watched_peaks']
 
-    return runs
+    def __init__(self, LogFile, NmhcLine):
+        self._peak_name_cache = None
+        self._peak_rt_cache = None
+        self._watched_peaks = None
+        self.log_con = LogFile
+        self.nmhc_con = NmhcLine
+        self.type = sample_types.get(LogFile.sampletype, None)
 
+    def __getattr__(self, attr):
+        if attr in log_params_list:
+            return getattr(self.log_con, attr)
+        raise AttributeError(attr)
 
-def connect_to_reservoir_db(engine_str, directory):
-    """
-    Example:
-    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', dir)
+    @property
+    def peaks(self):
+        return self.nmhc_con.peaklist
 
-    Takes string name of the database to create/connect to, and the directory it should be in.
+    @property
+    def date_end(self):
+        return self.nmhc_con.date
 
-    engine_str: str, name of the database to create/connect to.
-    directory: str/path, directory that the database should be made/connected to in.
-        Requires context manager TempDir in order to work with async
-    """
-    from reservoir_nmhc import Base, TempDir
+    @property
+    def date_start(self):
+        return self.log_con.date
 
-    from sqlalchemy import create_engine
-    from sqlalchemy.orm import sessionmaker
+    def __str__(self):
+        return f'<run record at {self.date_end}>'
 
-    with TempDir(directory):
-        engine = create_engine(engine_str)
-    Session = sessionmaker(bind=engine)
-    sess = Session()
+    def __repr__(self):
+        return f'<run record at {self.date_end}>'
 
-    return engine, sess, Base
 
-def fix_off_dates(LogFiles, NmhcLines):
+def load_single_records(session):
     """
-    Loop through a provided list of LogFile objects and correct the dates if necessary.
-    A short period in the log files are mis-recorded, and a longer period in the NMHC_PA.LOG
-    were also mis-recorded.
+    Loads all single (unmatched) logs and lines from the db as LogRecords and PaLineRecords (with their peaks),
+    through SQLAlchemy Core, so no ORM objects are made for them.
 
-    % Correct dates for logdata - All dates prior to 13:00 MST on 4/11/2017
-    % have to be corrected. Those dates were recorded as MDT, so subtracting an
-    % hour will put them in MST. The first "correct" run was at 13:10 MST,
-    % and the last "bad" run was at 12:50 MDT.
+    Returns (LogRecords, PaLineRecords), each ordered by id.
+    """
+    from sqlalchemy import select
 
-    % Correct dates for NMHC_PA Lines - All dates prior to 15:45 MST on 4/27/2017
-    % have to be corrected. Those dates were recorded as MDT, so subtracting an
-    % hour will put them in MST. The first "correct" run was at ~15:50 MST,
-    % and the last "bad" run was at 14:59 MDT.
+    logs = LogFile.__table__
+    lines = NmhcLine.__table__
+    peaks = Peak.__table__
 
-    Parameters:
+    log_records = [LogRecord(dict(row)) for row in
+                   session.execute(select([logs]).where(logs.c.status == 'single').order_by(logs.c.id))]
 
-    LogFiles: list, of LogFile objects
-    NmhcLines: list, of NmhcLine objects
-    """
+    line_records = dict()
+    for line_id, date in session.execute(select([lines.c.id, lines.c.date])
+                                         .where(lines.c.status == 'single').order_by(lines.c.id)):
+        line_records[line_id] = PaLineRecord(date, [], id=line_id)
 
-    for log in LogFiles:
-        if datetime(2017,3,12,2,0,0) < log.date < datetime(2017,4,11,13,0,0):
-            log.date = log.date - dt.timedelta(hours = 1)
+    single_ids = select([lines.c.id]).where(lines.c.status == 'single')
+    for row in session.execute(select([peaks]).where(peaks.c.line_id.in_(single_ids)).order_by(peaks.c.id)):
+        line_records[row.line_id].peaklist.append(PeakRecord(row.name, row.pa, row.rt, id=row.id, mr=row.mr,
+                                                             rev=row.rev, qc=row.qc))
 
-    for line in NmhcLines:
-        if datetime(2017,3,12,2,0,0) < line.date < datetime(2017,4,27,15,5,0):
-            line.date = line.date - dt.timedelta(hours = 1)
+    return log_records, list(line_records.values())
 
 
-def check_filesize(filename):
-    '''Returns filesize in bytes'''
-    if os.path.isfile(filename):
-        return os.path.getsize(filename)
-    else:
-        print(f'File {filename} not found.')
-        return
+def bulk_insert_runs(session, RunRecords):
+    """
+    Writes RunRecords of logs and lines loaded with load_single_records: marks their logs and lines married,
+    writes back any peaks renamed (ie by check_c4_rts), and inserts their gcruns rows, with one executemany
+    each. The session is not committed.
 
+    Returns the ids of the inserted gcruns rows.
 
-class TempDir():
-    """
-    Context manager for working in a directory temporarily.
+    session: the session to write with
+    RunRecords: list, of RunRecords whose log_con and nmhc_con have ids
     """
-    def __init__(self, path):
-        self.old_dir = os.getcwd()
-        self.new_dir = path
+    from sqlalchemy import bindparam, select
 
-    def __enter__(self):
-        os.chdir(self.new_dir)
+    if len(RunRecords) == 0:
+        return []
 
-    def __exit__(self, *args):
-        os.chdir(self.old_dir)
+    logs = LogFile.__table__
+    lines = NmhcLine.__table__
+    peaks = Peak.__table__
 
+    session.execute(logs.update().where(logs.c.id == bindparam('_id')).values(status=bindparam('_status')),
+                    [{'_id': run.log_con.id, '_status': run.log_con.status} for run in RunRecords])
 
-def get_dates_mrs(res_session, compound, date_start=None, date_end=None):
+    session.execute(lines.update().where(lines.c.id == bindparam('_id')).values(status=bindparam('_status')),
+                    [{'_id': run.nmhc_con.id, '_status': run.nmhc_con.status} for run in RunRecords])
 
-    if date_start is None and date_end is None:
-        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
-                     .join(NmhcLine).join(GcRun).join(LogFile)) # get everything
-        mrs, dates = zip(*peak_info.all())
-        return mrs, dates
+    renamed = [{'_id': peak.id, '_name': peak.name} for run in RunRecords for peak in run.peaks if peak.renamed]
 
-    elif date_start is None:
-        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
-                     .join(NmhcLine).join(GcRun).join(LogFile)
-                     .filter(LogFile.date < date_end)) # get only before the end date given
-        mrs, dates = zip(*peak_info.all())
-        return mrs, dates
+    if len(renamed) != 0:
+        session.execute(peaks.update().where(peaks.c.id == bindparam('_id')).values(name=bindparam('_name')),
+                        renamed)
 
-    elif date_end is None:
-        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
-                     .join(NmhcLine).join(GcRun).join(LogFile)
-                     .filter(LogFile.date > date_start))
-        mrs, dates = zip(*peak_info.all()) # get only after the start date given
-        return mrs, dates
+    session.execute(GcRun.__table__.insert(), [{'type': run.type, 'logfile_id': run.log_con.id,
+                                                'nmhcline_id': run.nmhc_con.id} for run in RunRecords])
 
-    else:
-        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
-                     .join(NmhcLine).join(GcRun).join(LogFile)
-                     .filter(LogFile.date.between(date_start, date_end))) # get between date bookends (inclusive beginning!)
-        mrs, dates = zip(*peak_info.all())
-        return mrs, dates
+    runs = GcRun.__table__
+
+    run_ids = []  # executemany doesn't return ids, so look them up by their (just married) lines
+    for line_ids in chunked([run.nmhc_con.id for run in RunRecords]):
+        run_ids.extend(run_id for run_id, in session.execute(select([runs.c.id])
+                                                             .where(runs.c.nmhcline_id.in_(line_ids))))
 
+    return sorted(run_ids)
 
-def res_nmhc_plot(dates, compound_dict, limits=None, minor_ticks=None, major_ticks=None):
+
+def integrate_batch(session, GcRuns):
     """
-    Versatile dat plotter for the project with a dynamic duration/tick scheme for web-ready plots.
+    Integrates many GcRuns at once, giving the same mixing ratios as calling GcRun.integrate() on each one.
 
-    Example with all dates supplied:
-        res_nmhc_plot((None, {'Ethane':[[date, date, date], [1, 2, 3]],
-                                'Propane':[[date, date, date], [.5, 1, 1.5]]}))
+    Rather than walking each run's peaks through association proxies, the peak areas, sample times and flows of
+    all runs are pulled with one query, crfs and ECNs are looked up into NumPy arrays, every mixing ratio is
+    calculated in one vectorized pass, and they're written back with one bulk update. The session is not committed.
 
-    Example with single date list supplied:
-        res_nmhc_plot([date, date, date], {'ethane':[None, [1, 2, 3]],
-                                'propane':[None, [.5, 1, 1.5]]})
+    Runs must already have their crfs assigned (ie from a CrfIndex). Only ambient and zero runs with crfs are
+    integrated, and a list of those runs is returned so the caller can create (or revise) their Datum. Runs whose
+    log has no (or a zero) sample time or flow can't be integrated, where GcRun.integrate() would raise, so they're
+    reported and left out rather than given NaN or infinite mixing ratios.
 
-    dates: list, of Python datetimes; if set, this applies to all compounds.
-        If None, each compound supplies its own date values
-    compound_dict: dict, {'compound_name':[dates, mrs]}
-        keys: str, the name to be plotted and put into filename
-        values: list, len(list) == 2, two parallel lists that are...
-            dates: list, of Python datetimes. If None, dates come from dates input parameter (for all compounds)
-            mrs: list, of [int/float/None]s; these are the mixing ratios to be plotted
+    session: the session the runs belong to
+    GcRuns: list, of GcRun objects
+    """
+    import numpy as np
+
+    runs = [run for run in GcRuns if run.crfs is not None and run.type in integrated_types]
+
+    if len(runs) == 0:
+        return []
+
+    session.flush()  # runs need ids and their assigned crfs in the db before querying
+
+    unusable = set()
+    for chunk in chunked([run.id for run in runs]):
+        unusable.update(run_id for run_id, sampletime, sampleflow
+                        in (session.query(GcRun.id, LogFile.sampletime, LogFile.sampleflow1)
+                            .join(LogFile, LogFile.id == GcRun.logfile_id)
+                            .filter(GcRun.id.in_(chunk)))
+                        if not sampletime or not sampleflow)  # None or 0 would give NaN or infinite mrs
+
+    if len(unusable) != 0:
+        bad_runs = sorted((run for run in runs if run.id in unusable), key=lambda run: run.id)
+        print(f'{len(bad_runs)} runs had no sample time or flow and could not be integrated, '
+              + f'from {bad_runs[0].date_end} to {bad_runs[-1].date_end}.')
+
+        runs = [run for run in runs if run.id not in unusable]
+
+        if len(runs) == 0:
+            return []
+
+    run_ids = np.array(sorted(run.id for run in runs))
+    compounds = np.array(sorted(compound_list))
+
+    crf_table = np.full((len(run_ids), len(compounds)), np.nan)  # crf for each run and compound, nan if missing
+    for run in runs:
+        run_ind = np.searchsorted(run_ids, run.id)
+        for comp_ind, compound in enumerate(compounds):
+            crf = run.crfs.compounds.get(compound, None)
+            if crf is not None:
+                crf_table[run_ind, comp_ind] = crf
+
+    ecns = np.array([compound_ecns[compound] for compound in compounds], dtype=float)
+
+    rows = []
+    for chunk in chunked(run_ids.tolist()):
+        rows.extend(session.query(Peak.id, Peak.name, Peak.pa, GcRun.id, LogFile.sampletime, LogFile.sampleflow1)
+                    .join(GcRun, GcRun.nmhcline_id == Peak.line_id)
+                    .join(LogFile, LogFile.id == GcRun.logfile_id)
+                    .filter(GcRun.id.in_(chunk))
+                    .filter(Peak.name.in_(compound_list))
+                    .all())
+
+    if len(rows) == 0:
+        return runs
+
+    peak_ids, names, pas, peak_run_ids, sampletimes, sampleflows = zip(*rows)
+
+    run_inds = np.searchsorted(run_ids, np.array(peak_run_ids))
+    comp_inds = np.searchsorted(compounds, np.array(names))
+
+    pas = np.array(pas, dtype=float)
+    crfs = crf_table[run_inds, comp_inds]
+    sampletimes = np.array(sampletimes, dtype=float)
+    sampleflows = np.array(sampleflows, dtype=float)
+
+    mrs = (pas / (crfs * ecns[comp_inds] * sampletimes * sampleflows)) * 600 * 1
+    # formula is (pa / (CRF * ECN * SampleTime * SampleFlow1)) * 600 *1, as in GcRun.integrate()
+
+    has_crf = ~np.isnan(crfs)  # peaks without a crf for their compound are left alone, as in GcRun.integrate()
+
+    session.bulk_update_mappings(Peak, [{'id': peak_id, 'mr': mr} for peak_id, mr
+                                        in zip(np.array(peak_ids)[has_crf].tolist(), mrs[has_crf].tolist())])
+
+    return runs
+
+
+def refresh_mixing_ratios(session, run_ids=None):
+    """
+    (Re)writes the MixingRatios rows of integrated runs from their peaks, with one INSERT OR REPLACE ... SELECT
+    that pivots each run's peaks into columns in the db. The session is flushed first, but not committed.
+
+    A compound is expected to appear once per run; if a run has several peaks with the same name, the first one
+    (lowest peak id) is kept, as it is by GcRun.get_mr and get_dates_mrs_multi.
+
+    session: the session to write with
+    run_ids: list, of GcRun ids to refresh; if None, every integrated run is refreshed
+    """
+    from sqlalchemy import select, func, case, and_, exists
+
+    session.flush()
+
+    runs = GcRun.__table__
+    data = Datum.__table__
+    logs = LogFile.__table__
+    lines = NmhcLine.__table__
+    peaks = Peak.__table__
+    earlier = peaks.alias('earlier')
+
+    is_first = ~exists().where(and_(earlier.c.name == peaks.c.name, earlier.c.line_id == peaks.c.line_id,
+                                    earlier.c.id < peaks.c.id))  # no same-named peak before it in its line
+
+    columns = ([logs.c.date, lines.c.date, runs.c.id, runs.c.data_id, runs.c.type, data.c.qc]
+               + [func.max(case([(peaks.c.name == compound, peaks.c.mr)])) for compound in compound_list])
+    # with only the first peak of each name joined, max() just picks out each compound's one mixing ratio
+
+    names = (['date', 'date_end', 'run_id', 'data_id', 'type', 'qc']
+             + [compound_columns[compound] for compound in compound_list])
+
+    pivot = (select(columns)
+             .select_from(runs
+                          .join(data, runs.c.data_id == data.c.id)
+                          .join(logs, runs.c.logfile_id == logs.c.id)
+                          .join(lines, runs.c.nmhcline_id == lines.c.id)
+                          .outerjoin(peaks, and_(peaks.c.line_id == lines.c.id, peaks.c.name.in_(compound_list),
+                                                 is_first)))
+             .group_by(runs.c.id))
+
+    insert = MixingRatios.__table__.insert().prefix_with('OR REPLACE', dialect='sqlite')
+
+    if run_ids is None:
+        session.execute(insert.from_select(names, pivot))
+    else:
+        for chunk in chunked(run_ids):
+            session.execute(insert.from_select(names, pivot.where(runs.c.id.in_(chunk))))
+
+
+def refresh_daily_summaries(session, run_ids=None):
+    """
+    (Re)computes the DailySummary rows of every day that has one of the given runs in MixingRatios, so it must
+    be called after refresh_mixing_ratios. Each touched day is deleted and recomputed from its runs in the db,
+    so a reintegrated run's old values are replaced rather than double-counted, and min/max stay exact. Only a
+    day's runs are read, so this stays cheap as the archive grows. The session is flushed first, but not committed.
+
+    session: the session to write with
+    run_ids: list, of GcRun ids whose days should be refreshed; if None, every day is refreshed
+    """
+    from sqlalchemy import select, func, literal, union_all
+
+    session.flush()
+
+    mrs = MixingRatios.__table__
+    summaries = DailySummary.__table__
+    day = func.date(mrs.c.date)
+
+    def summarize(days=None):
+        selects = []
+        for compound in compound_list:
+            col = mrs.c[compound_columns[compound]]
+            summary = (select([day, literal(compound), mrs.c.type, func.count(col), func.sum(col),
+                               func.sum(col * col), func.min(col), func.max(col)])
+                       .where(mrs.c.type.in_(summary_types))
+                       .group_by(day, mrs.c.type))
+
+            if days is not None:
+                summary = summary.where(day.in_(days))
+
+            selects.append(summary)
+
+        return union_all(*selects)
+
+    names = ['date', 'compound', 'type', 'count', 'sum', 'sumsq', 'min', 'max']
+
+    if run_ids is None:
+        session.execute(summaries.delete())
+        session.execute(summaries.insert().from_select(names, summarize()))
+        return
+
+    days = set()
+    for chunk in chunked(run_ids):
+        days.update(d for d, in session.execute(select([day]).where(mrs.c.run_id.in_(chunk)).distinct()))
+
+    for chunk in chunked(sorted(days), 50):  # each chunk is used once per compound in the union
+        session.execute(summaries.delete().where(summaries.c.date.in_([dt.date.fromisoformat(d) for d in chunk])))
+        # compared on the bare column so its primary key index is used; the Date type binds date objects as
+        # the same 'YYYY-MM-DD' text the summaries are stored with
+        session.execute(summaries.insert().from_select(names, summarize(chunk)))
+
+
+def get_summaries(res_session, compounds, sample_type='ambient', freq='daily', date_start=None, date_end=None):
+    """
+    Gets daily or monthly statistics of several compounds from the DailySummary table, rolling days up into
+    months in the db. Periods where a compound has no values get a count of 0 and None for the rest.
+
+    Returns (periods, {compound: {stat: list aligned with periods}}), where periods are the dates each period
+    starts on, and stats are 'mean', 'std', 'min', 'max' and 'count'.
+
+    res_session: the session to query with
+    compounds: list, of compound names, ie ['ethane', 'propane']
+    sample_type: str, one of summary_types
+    freq: str, 'daily' or 'monthly'
+    date_start: date, first day (inclusive) to include, optional
+    date_end: date, last day (inclusive) to include, optional
+    """
+    import math
+    from sqlalchemy import func
+
+    if freq == 'daily':
+        period = DailySummary.date
+    elif freq == 'monthly':
+        period = func.strftime('%Y-%m-01', DailySummary.date)
+    else:
+        raise ValueError(f"freq must be 'daily' or 'monthly', not '{freq}'")
+
+    rows = (res_session.query(period, DailySummary.compound, func.sum(DailySummary.count),
+                              func.sum(DailySummary.sum), func.sum(DailySummary.sumsq),
+                              func.min(DailySummary.min), func.max(DailySummary.max))
+            .filter(DailySummary.type == sample_type)
+            .filter(DailySummary.compound.in_(compounds)))
+
+    if date_start is not None:
+        rows = rows.filter(DailySummary.date >= date_start)
+    if date_end is not None:
+        rows = rows.filter(DailySummary.date <= date_end)
+
+    rows = rows.group_by(period, DailySummary.compound).all()
+
+    by_period = dict()
+    for p, compound, count, total, sumsq, low, high in rows:
+        if isinstance(p, str):
+            p = datetime.strptime(p, '%Y-%m-%d').date()
+
+        stats = {'count': count or 0, 'mean': None, 'std': None, 'min': low, 'max': high}
+
+        if count:
+            stats['mean'] = total / count
+            if count > 1:
+                stats['std'] = math.sqrt(max(sumsq - total * total / count, 0) / (count - 1))
+
+        by_period.setdefault(p, dict())[compound] = stats
+
+    periods = sorted(by_period)
+    empty = {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None}
+
+    summaries = {compound: {stat: [by_period[p].get(compound, empty)[stat] for p in periods] for stat in empty}
+                 for compound in compounds}
+
+    return periods, summaries
+
+
+def get_wide_mrs(res_session, compounds, date_start=None, date_end=None):
+    """
+    Gets the mixing ratios of several compounds from the MixingRatios table, in the same form and with the same
+    date filtering as get_dates_mrs_multi: (dates, {compound: list aligned with dates}). Only integrated runs
+    are included.
+
+    res_session: the session to query with
+    compounds: list, of compound names, ie ['ethane', 'propane']
+    """
+
+    columns = [getattr(MixingRatios, compound_columns[compound]) for compound in compounds]
+    rows = res_session.query(MixingRatios.date, *columns)
+
+    if date_start is not None and date_end is not None:
+        rows = rows.filter(MixingRatios.date.between(date_start, date_end))
+    elif date_start is not None:
+        rows = rows.filter(MixingRatios.date > date_start)
+    elif date_end is not None:
+        rows = rows.filter(MixingRatios.date < date_end)
+
+    rows = rows.order_by(MixingRatios.date).all()
+
+    if len(rows) == 0:
+        return [], {compound: [] for compound in compounds}
+
+    dates, *series = zip(*rows)
+
+    return list(dates), {compound: list(mrs) for compound, mrs in zip(compounds, series)}
+
+
+aggregate_freqs = {'hourly': 'datetime64[h]', 'daily': 'datetime64[D]', 'monthly': 'datetime64[M]'}
+# NumPy units each run's date is truncated to when binning runs for aggregation
+
+aggregate_stats = ['mean', 'median', 'min', 'max', 'count']
+
+
+def aggregate_mrs(dates, mrs, freq='daily'):
+    """
+    Bins mixing ratios by hour, day or month and returns the mean, median, min, max and count of each bin.
+    Binning is vectorized with NumPy; Nones are left out of every statistic, and bins with no values for a
+    compound get a count of 0 and None for the rest.
+
+    Returns (bins, {compound: {stat: list aligned with bins}}), where bins are the datetimes each bin starts at.
+
+    dates: list, of sorted datetimes, ie from get_wide_mrs
+    mrs: dict, of {compound: list of mixing ratios} aligned with dates
+    freq: str, one of 'hourly', 'daily' or 'monthly'
+    """
+    import numpy as np
+
+    if freq not in aggregate_freqs:
+        raise ValueError(f"freq must be one of {', '.join(aggregate_freqs)}, not '{freq}'")
+
+    if len(dates) == 0:
+        return [], {compound: {stat: [] for stat in aggregate_stats} for compound in mrs}
+
+    binned = np.array(dates, dtype='datetime64[us]').astype(aggregate_freqs[freq])
+    bins, inverse = np.unique(binned, return_inverse=True)
+
+    aggregates = dict()
+    for compound, values in mrs.items():
+        values = np.array([np.nan if v is None else v for v in values], dtype=float)
+        valid = ~np.isnan(values)
+
+        counts = np.bincount(inverse[valid], minlength=len(bins))
+        sums = np.bincount(inverse[valid], weights=values[valid], minlength=len(bins))
+
+        order = np.lexsort((values, inverse))  # by bin, then value; NaNs sort to the end of each bin
+        starts = np.searchsorted(inverse[order], np.arange(len(bins)))
+        ordered = values[order]
+
+        has = counts > 0
+        lower = ordered[np.where(has, starts + (counts - 1) // 2, 0)]
+        upper = ordered[np.where(has, starts + counts // 2, 0)]
+
+        stats = {'mean': np.where(has, sums / np.maximum(counts, 1), np.nan),
+                 'median': np.where(has, (lower + upper) / 2, np.nan),
+                 'min': np.where(has, ordered[starts], np.nan),
+                 'max': np.where(has, ordered[np.where(has, starts + counts - 1, 0)], np.nan)}
+
+        aggregates[compound] = {stat: [None if np.isnan(v) else float(v) for v in stats[stat]]
+                                for stat in stats}
+        aggregates[compound]['count'] = counts.tolist()
+
+    return bins.astype('datetime64[us]').astype(dt.datetime).tolist(), aggregates
+
+
+def get_aggregate_mrs(res_session, compounds, freq='daily', date_start=None, date_end=None):
+    """
+    Gets hourly, daily or monthly statistics of several compounds from the MixingRatios table; see aggregate_mrs
+    for what's returned and get_wide_mrs for the date filtering.
+
+    res_session: the session to query with
+    compounds: list, of compound names, ie ['ethane', 'propane']
+    freq: str, one of 'hourly', 'daily' or 'monthly'
+    """
+
+    dates, mrs = get_wide_mrs(res_session, compounds, date_start=date_start, date_end=date_end)
+
+    return aggregate_mrs(dates, mrs, freq)
+
+
+def lttb(dates, values, threshold):
+    """
+    Downsamples a line to at most threshold points with Largest-Triangle-Three-Buckets, which keeps the points
+    that most shape the line (peaks, dips) rather than averaging them away. Nones are dropped first.
+
+    Returns (dates, values) as lists; lines already at or under the threshold are returned without the Nones.
+
+    dates: list, of sorted datetimes
+    values: list, of [int/float/None]s aligned with dates
+    threshold: int, most points to return; at least 3
+    """
+    import numpy as np
+
+    points = [(d, v) for d, v in zip(dates, values) if v is not None]
+
+    if len(points) <= threshold or threshold < 3:
+        return [p[0] for p in points], [p[1] for p in points]
+
+    x = np.array([p[0].timestamp() for p in points])
+    y = np.array([p[1] for p in points], dtype=float)
+
+    edges = np.linspace(1, len(points) - 1, threshold - 1).astype(int)  # buckets between the fixed first/last points
+
+    keep = [0]
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+
+        if i + 2 < len(edges):
+            next_x = x[edges[i + 1]:edges[i + 2]].mean()
+            next_y = y[edges[i + 1]:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        prev_x, prev_y = x[keep[-1]], y[keep[-1]]
+
+        areas = np.abs((prev_x - next_x) * (y[start:end] - prev_y) - (prev_x - x[start:end]) * (next_y - prev_y))
+        keep.append(start + int(areas.argmax()))
+    keep.append(len(points) - 1)
+
+    return [points[i][0] for i in keep], [points[i][1] for i in keep]
+
+
+def find_crf(crfs, sample_date):
+    """
+    Returns the carbon response factor object for a sample at the given sample_date
+
+    crfs: list, of crf objects
+    sample_date: datetime, the date_start attribute of a sample
+    """
+
+    return next((crf for crf in crfs if crf.date_start <= sample_date < crf.date_end), None)
+
+
+class CrfIndex():
+    """
+    An interval index of Crfs by date, built once from all Crfs and reused to look up the Crf for many runs with
+    a bisect, rather than scanning every Crf for each run.
+
+    Where Crf periods overlap, the one with the latest revision_date applies for the overlap (ties go to the later
+    date_start), so a revised Crf supersedes an older one without the older one being deleted. Dates not covered
+    by any Crf fall in a gap and find no Crf.
+
+    Example:
+        index = CrfIndex(session.query(Crf).all())
+        run.crfs = index.find(run.date_end)
+
+    crfs: list, of Crf objects
+    """
+
+    def __init__(self, crfs):
+        crfs = [crf for crf in crfs if crf.date_start is not None and crf.date_end is not None]
+        boundaries = sorted({crf.date_start for crf in crfs} | {crf.date_end for crf in crfs})
+
+        def priority(crf):
+            return (crf.revision_date or datetime.min, crf.date_start)
+
+        self.starts = []  # start of each segment, sorted
+        self.crfs = []  # the Crf applying for each segment, or None for gaps
+
+        for seg_start, seg_end in zip(boundaries, boundaries[1:]):
+            covering = [crf for crf in crfs if crf.date_start <= seg_start and seg_end <= crf.date_end]
+            crf = max(covering, key=priority) if len(covering) != 0 else None
+
+            if len(self.crfs) != 0 and self.crfs[-1] is crf:
+                continue  # same crf as the last segment, so extend it rather than adding another
+
+            self.starts.append(seg_start)
+            self.crfs.append(crf)
+
+        if len(boundaries) != 0:
+            self.starts.append(boundaries[-1])
+            self.crfs.append(None)  # everything after the last crf ends is uncovered
+
+    def find(self, sample_date):
+        """
+        Returns the Crf that applies at sample_date, or None if it falls before, after, or between Crf periods.
+        """
+        from bisect import bisect_right
+
+        ind = bisect_right(self.starts, sample_date) - 1
+
+        if ind < 0:
+            return None
+
+        return self.crfs[ind]
+
+    def __len__(self):
+        return len({id(crf) for crf in self.crfs if crf is not None})
+
+    def __repr__(self):
+        return f'<CrfIndex of {len(self)} crfs in {len(self.starts)} segments>'
+
+
+def diff_crfs(new_crfs, stored_crfs):
+    """
+    Compares Crfs parsed from the CRF file against those stored in the db, matching them by date_start. If the file
+    has several revisions of one period, only the one with the latest revision_date is used (ties go to the later
+    line in the file).
+
+    Returns (added, changed, removed), where added is a list of new Crfs with no stored counterpart, changed is a
+    list of (stored, new) Crf pairs where the date_end, revision_date or any compound's crf differs, and removed is
+    a list of stored Crfs whose period no longer appears in the file.
+
+    new_crfs: list, of Crf objects, ie from read_crf_data()
+    stored_crfs: list, of Crf objects from the db
+    """
+
+    def revision(crf):
+        return crf.revision_date or datetime.min
+
+    latest_by_start = dict()
+    for new in new_crfs:
+        latest = latest_by_start.get(new.date_start)
+        if latest is None or revision(new) >= revision(latest):
+            latest_by_start[new.date_start] = new
+
+    stored_by_start = {crf.date_start: crf for crf in stored_crfs}
+
+    added = []
+    changed = []
+
+    for new in latest_by_start.values():
+        stored = stored_by_start.get(new.date_start)
+
+        if stored is None:
+            added.append(new)
+        elif (stored.date_end != new.date_end
+              or stored.revision_date != new.revision_date
+              or dict(stored.compounds) != dict(new.compounds)):
+            changed.append((stored, new))
+
+    removed = [crf for crf in stored_crfs if crf.date_start not in latest_by_start]
+
+    return added, changed, removed
+
+
+def reintegrate_changed_crfs(session, new_crfs):
+    """
+    Brings the stored Crfs up to date with new_crfs, and reintegrates only the already-integrated runs whose
+    date_end falls in a period that was added, changed or removed. Each reintegrated run's Datum has its revision
+    bumped. Runs that haven't been integrated yet are left for integrate_runs. The session is not committed.
+
+    Stored Crfs that are no longer in the file are deleted first, then changed ones are updated, then new ones are
+    added, flushing between each so no step can collide with a date that's about to be freed. Integrated runs left
+    with no Crf at all have their mixing ratios cleared, since the Crf they were integrated with is gone.
+
+    Returns the list of reintegrated GcRuns.
+
+    session: the session to use
+    new_crfs: list, of Crf objects, ie from read_crf_data()
+    """
+    from sqlalchemy import and_, or_
+
+    added, changed, removed = diff_crfs(new_crfs, session.query(Crf).all())
+
+    if len(added) == 0 and len(changed) == 0 and len(removed) == 0:
+        return []
+
+    intervals = [(crf.date_start, crf.date_end) for crf in added + removed]
+
+    for crf in removed:
+        session.delete(crf)
+    session.flush()
+
+    for stored, new in changed:
+        intervals.append((stored.date_start, max(stored.date_end, new.date_end)))  # covers old and new extents
+        stored.date_end = None  # frees every old date_end before any is reused
+    session.flush()
+
+    for stored, new in changed:
+        stored.date_end = new.date_end
+        stored.revision_date = new.revision_date
+        stored.compounds = dict(new.compounds)
+    session.flush()
+
+    session.add_all(added)
+    session.flush()
+
+    runs = (session.query(GcRun)
+            .join(NmhcLine, GcRun.nmhcline_id == NmhcLine.id)
+            .filter(GcRun.data_id != None)
+            .filter(or_(*[and_(NmhcLine.date >= start, NmhcLine.date < end) for start, end in intervals]))
+            .all())
+
+    crf_index = CrfIndex(session.query(Crf).all())
+
+    for run in runs:
+        run.crfs = crf_index.find(run.date_end)
+
+    reintegrated = integrate_batch(session, runs)
+
+    uncovered = [run for run in runs if run.crfs is None]
+
+    if len(uncovered) != 0:
+        print(f'{len(uncovered)} integrated runs no longer fall in any CRF period, so their mixing ratios were '
+              + 'cleared.')
+
+        for line_ids in chunked([run.nmhcline_id for run in uncovered]):
+            (session.query(Peak)
+             .filter(Peak.line_id.in_(line_ids))
+             .update({Peak.mr: None}, synchronize_session=False))
+
+    for run in reintegrated + uncovered:
+        run.data_con.revision += 1
+
+    refresh_mixing_ratios(session, [run.id for run in reintegrated + uncovered])
+    refresh_daily_summaries(session, [run.id for run in reintegrated + uncovered])
+
+    return reintegrated
+
+
+def read_crf_data(filename):
+    """
+    Reads the tab-delimited CRF file into a list of Crfs, or returns None if it doesn't exist.
+
+    filename: str/path, path to the CRF file
+    """
+
+    try:
+        lines = open(filename).readlines()
+    except FileNotFoundError:
+        print('CRF File not found. No runs can be integrated.')
+        return
+
+    keys = lines[0].split('\t')[3:] #list of strs of all compound names from file
+
+    Crfs = []
+
+    for line in lines[1:]:
+        compounds = dict()  # each crf needs its own dict, or they'd all share the last line's values
+
+        ls = line.split('\t')
+        date_start = datetime.strptime(ls[0], '%m/%d/%Y %H:%M')
+        date_end = datetime.strptime(ls[1], '%m/%d/%Y %H:%M')
+        date_revision = datetime.strptime(ls[2], '%m/%d/%Y %H:%M')
+
+        for index, (key, rf) in enumerate(zip(keys,ls[3:])):
+            key = key.strip().lower()
+            #unpack all names from header as keys and line items as values
+            compounds[key] = float(rf)
+
+        if date_start is not None and date_end is not None:
+            Crfs.append(Crf(date_start, date_end, date_revision, compounds, 'working standard'))
+
+    return Crfs
+
+
+class LogFormatError(ValueError):
+    """
+    Raised when a log file can't be parsed, with the details of why.
+
+    filename: str, the log file's name
+    reason: str, what was wrong with it
+    line: int, the (1-based) line number of the problem, if it was one line
+    """
+
+    def __init__(self, filename, reason, line=None):
+        super().__init__(filename, reason, line)
+        self.filename = filename
+        self.reason = reason
+        self.line = line
+
+    def __str__(self):
+        where = f' (line {self.line})' if self.line is not None else ''
+        return f'File {self.filename} could not be parsed{where}: {self.reason}.'
+
+
+def parse_log_file(filename, factory=None):
+    """
+    Parses a LabView log file into a LogFile, reading its values by their labels rather than their positions.
+    The version is detected from the labels present: the newest version whose labels all appear is used. Lines
+    with labels that version doesn't have (ie lines added to the VI since) are reported and skipped, rather than
+    shifting every value after them. The LogFile's filename is the file's name without its directory.
+
+    Raises LogFormatError if the file can't be read or decoded, its labels don't match any version in log_formats,
+    or a value can't be read.
+
+    filename: str/path, path to the log file
+    factory: class, made from the parsed values; defaults to LogFile, or use LogRecord for bulk loading
+    """
+
+    name = os.path.basename(filename)
+
+    try:
+        with open(filename) as file:
+            contents = file.read().splitlines()
+    except UnicodeDecodeError as e:
+        raise LogFormatError(name, f'it is not a text file ({e.reason} at byte {e.start})') from None
+    except OSError as e:
+        raise LogFormatError(name, f'it could not be read ({e.strerror or e})') from None
+
+    values = dict()  # {(label, occurrence): (line number, label, value)}
+    occurrences = dict()
+
+    for number, line in enumerate(contents, 1):
+        label, _, value = line.partition('\t')
+
+        raw_label = label
+        if label.isdigit():
+            label = log_date_label
+
+        occurrence = occurrences.get(label, 0)
+        occurrences[label] = occurrence + 1
+        values[(label, occurrence)] = (number, raw_label, value)
+
+    for version, fields in log_format_fields.items():
+        if all(key in values for key in fields):
+            break
+    else:
+        raise LogFormatError(name, f'its {len(contents)} lines did not match the labels of any known log version')
+
+    unknown = [values[key][1] for key in values if key not in fields and values[key][1] != '']
+    if len(unknown) != 0:
+        print(f'File {name} had unrecognized lines {unknown}, which were skipped; read as log version {version}.')
+
+    log_dict = {'filename': name}
+
+    for key, attr in fields.items():
+        if attr is None:
+            continue
+
+        number, raw_label, value = values[key]
+
+        try:
+            if attr == 'samplecode':
+                log_dict['samplecode'] = int(raw_label)
+                log_dict['date'] = datetime.strptime(raw_label, '%Y%j%H%M%S')
+            elif attr in log_int_fields:
+                log_dict[attr] = int(float(value))
+            else:
+                log_dict[attr] = float(value)
+        except ValueError:
+            raise LogFormatError(name, f'the value {value!r} for {attr} could not be read', number) from None
+
+    return (LogFile if factory is None else factory)(log_dict)
+
+
+def read_log_file(filename, errors=None, factory=None):
+    """
+    Reads a LabView log file into a LogFile with parse_log_file, or returns None if it can't be parsed. Files that
+    can't be parsed are reported, and their LogFormatErrors are appended to errors if a list is given.
+
+    filename: str/path, path to the log file
+    errors: list, optional; collects a LogFormatError for each file that couldn't be parsed
+    factory: class, made from the parsed values; defaults to LogFile, or use LogRecord for bulk loading
+    """
+
+    try:
+        return parse_log_file(filename, factory)
+    except LogFormatError as e:
+        print(f'{e} It was ignored.')
+
+        if errors is not None:
+            errors.append(e)
+
+        return None
+
+
+def read_pa_line(line):
+
+    """
+    read_pa_line takes one line as a str from the NMHC_PA.LOG file, and parses it
+        into an NmhcLine object
+
+    line: str, a line from NMHC_PA.LOG
+    """
+
+    ls = line.split('\t')
+    line_peaks = []
+
+    line_date = datetime.strptime(ls[1] + ' ' + ls[2], '%m/%d/%Y %H:%M:%S')
+
+    for ind, item in enumerate(ls[3:]):
+
+        ind = ind+3 # offset ind since we're working with ls[3:]
+
+        peak_dict = dict()
+
+        if '"' in item:
+
+            peak_dict['name'] = item.strip('"') # can't fail, " is definitely there
+
+            try:
+                peak_dict['rt'] = float(ls[ind+1])
+            except:
+                peak_dict['rt'] = None
+            try:
+                peak_dict['pa'] = float(ls[ind+2])
+            except:
+                peak_dict['pa'] = None
+
+            if None not in peak_dict.values():
+                line_peaks.append(Peak(peak_dict['name'], peak_dict['pa'], peak_dict['rt']))
+
+    if len(line_peaks) == 0:
+        this_line = None
+    else:
+        this_line = NmhcLine(line_date, line_peaks)
+
+    return this_line
+
+
+def read_pa_columns(lines):
+    """
+    Parses many lines from NMHC_PA.LOG at once into columns, for bulk loading without creating an NmhcLine and
+    Peak per line and peak. Regular lines (a quoted name, rt and pa per peak) are split into triplets by slicing,
+    and the rts and pas of all of them are converted to floats in one NumPy call. Any line that isn't regular,
+    or has a value that isn't a number, is parsed by read_pa_line instead, so the results are always the same.
+
+    Returns (names, pa_lines):
+        names: list, of every peak name seen, lowercased as Peak does
+        pa_lines: list, of (date, name indices, rts, pas) per line with any peaks, where name indices index
+            names, and the others are aligned float64 arrays. Dates are as recorded; see fix_line_date.
+
+    lines: list, of str lines from NMHC_PA.LOG
+    """
+    import numpy as np
+
+    names = []
+    name_index = dict()
+
+    def index_names(line_names):
+        indices = []
+        for name in line_names:
+            index = name_index.get(name)
+            if index is None:
+                index = name_index[name] = len(names)
+                names.append(name)
+            indices.append(index)
+        return indices
+
+    parsed = []  # (date, names, rt tokens, pa tokens, line), with names None for irregular lines
+
+    for line in lines:
+        ls = line.rstrip('\r\n').split('\t')
+
+        try:
+            date = datetime.strptime(ls[1] + ' ' + ls[2], '%m/%d/%Y %H:%M:%S')
+        except (IndexError, ValueError):
+            print('A line in NMHC_PA.LOG could not be parsed due to an invalid date.')
+            print(f'The line was: {line}')
+            continue
+
+        tokens = ls[3:]
+        while len(tokens) != 0 and tokens[-1].strip() == '':
+            tokens.pop()  # trailing tabs
+
+        quoted = tokens[0::3]
+        rts, pas = tokens[1::3], tokens[2::3]
+
+        if (len(tokens) % 3 != 0 or not all(name[:1] == '"' for name in quoted)
+                or any('"' in value for value in rts) or any('"' in value for value in pas)):
+            parsed.append((date, None, None, None, line))
+        else:
+            parsed.append((date, [name.strip('"').lower() for name in quoted], rts, pas, line))
+
+    try:  # convert every regular line's values in one call
+        all_rts = np.array([rt for _, names_, rts, _, _ in parsed if names_ is not None for rt in rts],
+                           dtype=np.float64)
+        all_pas = np.array([pa for _, names_, _, pas, _ in parsed if names_ is not None for pa in pas],
+                           dtype=np.float64)
+    except ValueError:
+        all_rts = all_pas = None  # some value isn't a number, so convert line by line to find which
+
+    pa_lines = []
+    offset = 0
+
+    for date, peak_names, rts, pas, line in parsed:
+        if peak_names is not None:
+            if all_rts is not None:
+                count = len(rts)
+                rts, pas = all_rts[offset:offset + count], all_pas[offset:offset + count]
+                offset += count
+            else:
+                try:
+                    rts, pas = np.array(rts, dtype=np.float64), np.array(pas, dtype=np.float64)
+                except ValueError:
+                    peak_names = None
+
+        if peak_names is None:  # irregular, so let read_pa_line decide what's usable
+            nmhc_line = read_pa_line(line)
+
+            if nmhc_line is None:
+                continue
+
+            peak_names = [peak.name for peak in nmhc_line.peaklist]
+            rts = np.array([peak.rt for peak in nmhc_line.peaklist], dtype=np.float64)
+            pas = np.array([peak.pa for peak in nmhc_line.peaklist], dtype=np.float64)
+
+        if len(peak_names) == 0:
+            continue
+
+        pa_lines.append((date, np.array(index_names(peak_names), dtype=np.int32), rts, pas))
+
+    return names, pa_lines
+
+
+def find_closest_date(date, list_of_dates):
+    """
+    This is a helper function that works on Python datetimes. It returns the closest date value,
+    and the timedelta from the provided date.
+    """
+    match = min(list_of_dates, key = lambda x: abs(x - date))
+    delta = match - date
+
+    return match, delta
+
+
+def search_for_attr_value(obj_list, attr, value):
+    """
+    Finds the first (not necesarilly the only) object in a list, where its
+    attribute 'attr' is equal to 'value', returns None if none is found.
+    """
+    return next((obj for obj in obj_list if getattr(obj,attr, None) == value), None)
+
+
+def match_log_to_pa(LogFiles, NmhcLines, run_factory=None):
+    """
+    This takes a list of LogFile and NmhcLine objects and returns a list (empty, even)
+        of resulting GcRun objects. When matching objects, it WILL modify their parameters
+        and status if warranted. LogRecords and PaLineRecords can be matched into RunRecords the same way
+        by passing run_factory=RunRecord.
+
+    Both lists are sorted by date, and each log only considers the lines within 11 minutes of it, found by
+        bisecting the sorted line dates. Each line is matched to at most one log; if several logs could claim
+        a line, they're considered in date order and each takes the closest line still available.
+
+    LogFiles: list (of LogFile objects), any log files that need partners
+    NmhcLines: list (of NmhcLine objects), any NmhcLine objects that could be matched
+    run_factory: class, made from each matched (log, line) pair; defaults to GcRun
+
+    """
+    from bisect import bisect_left, bisect_right
+
+    run_factory = GcRun if run_factory is None else run_factory
+
+    window = dt.timedelta(minutes=11)
+
+    lines = sorted(NmhcLines, key=lambda line: line.date)
+    line_dates = [line.date for line in lines]
+    taken = [False] * len(lines)
+
+    runs = []
+
+    for log in sorted(LogFiles, key=lambda log: log.date):
+        # only lines strictly within the window of this log are candidates
+        lo = bisect_right(line_dates, log.date - window)
+        hi = bisect_left(line_dates, log.date + window)
+
+        best = None
+        for ind in range(lo, hi):
+            if not taken[ind] and (best is None or abs(line_dates[ind] - log.date) < abs(line_dates[best] - log.date)):
+                best = ind
+
+        if best is None:
+            continue  # no available line within the window
+
+        taken[best] = True
+        matched_line = lines[best]
+
+        runs.append(run_factory(log, matched_line))
+        log.status = 'married'
+        matched_line.status = 'married'
+
+    return runs
+
+
+_reservoir_engines = dict()  # engine url: (engine, Session, write Session), shared by everything in this process
+
+sqlite_pragmas = (['PRAGMA journal_mode=WAL',  # readers (ie plotting) don't block writers, and vice versa
+                   'PRAGMA synchronous=NORMAL',  # safe with WAL, and avoids an fsync per commit
+                   'PRAGMA cache_size=-65536',  # 64 MiB page cache per connection
+                   'PRAGMA mmap_size=268435456'])  # memory-map up to 256 MiB of the db file
+
+
+def get_reservoir_engine(engine_str, directory, write=False):
+    """
+    Returns the process-wide (engine, Session) pair for a database, creating it on first use. Creating it sets
+    SQLite to WAL journaling with tuned pragmas on every new connection, and creates the schema once. Connections
+    can be used from any thread.
+
+    Sessions from the write Session begin their transactions with BEGIN IMMEDIATE, taking SQLite's write lock up
+    front. Read sessions keep SQLite's deferred BEGIN, so they never wait on (or hold up) a writer.
+
+    A relative SQLite path is resolved against directory, so the working directory doesn't matter. An in-memory
+    SQLite db ('sqlite://' or 'sqlite:///:memory:') is kept on a single shared connection, since each new
+    connection to one would be a separate, empty db.
+
+    engine_str: str, name of the database to create/connect to, ie 'sqlite:///reservoir.sqlite'
+    directory: str/path, directory that a relative SQLite database should be made/connected to in
+    write: bool, return the Session for sessions that will write to the db
+    """
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import QueuePool, StaticPool
+
+    prefix = 'sqlite:///'
+    in_memory = engine_str in ('sqlite://', prefix + ':memory:')
+    if engine_str.startswith(prefix) and not in_memory:
+        engine_str = prefix + os.path.abspath(os.path.join(directory, engine_str[len(prefix):]))
+
+    if engine_str not in _reservoir_engines:
+        if engine_str.startswith('sqlite'):
+            engine = create_engine(engine_str, poolclass=StaticPool if in_memory else QueuePool,
+                                   connect_args={'check_same_thread': False, 'timeout': 30})
+            # pooled connections keep their page cache and mmap between sessions
+
+            @event.listens_for(engine, 'connect')
+            def set_sqlite_pragmas(dbapi_connection, connection_record):
+                dbapi_connection.isolation_level = None  # transactions are begun by begin_immediate() instead
+                cursor = dbapi_connection.cursor()
+                for pragma in sqlite_pragmas:
+                    cursor.execute(pragma)
+                cursor.close()
+
+            @event.listens_for(engine, 'begin')
+            def begin_sqlite(connection):
+                if connection.get_execution_options().get('sqlite_immediate'):
+                    connection.execute('BEGIN IMMEDIATE')
+                    # writers in different threads take the write lock up front, waiting up to the timeout for
+                    # it, rather than failing when a read transaction tries to become a write
+                else:
+                    connection.execute('BEGIN')  # deferred; readers take no lock until they read
+        else:
+            engine = create_engine(engine_str)
+
+        Base.metadata.create_all(engine)  # only once per process
+        migrate_reservoir_db(engine)
+
+        _reservoir_engines[engine_str] = (engine, sessionmaker(bind=engine),
+                                          sessionmaker(bind=engine.execution_options(sqlite_immediate=True)))
+
+    engine, Session, WriteSession = _reservoir_engines[engine_str]
+
+    return (engine, WriteSession) if write else (engine, Session)
+
+
+def migrate_reservoir_db(engine):
+    """
+    Brings an existing db up to date with the current schema where create_all can't. create_all only creates
+    missing tables (and their indexes), so indexes added to existing tables are created here, and materialized
+    and summary tables that are missing rows are filled.
+
+    engine: the engine of the db to migrate
+    """
+    from sqlalchemy import inspect
+
+    inspector = inspect(engine)
+
+    for table in Base.metadata.tables.values():
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name not in existing:
+                print(f'Creating index {index.name} on existing table {table.name}.')
+                index.create(engine)
+
+    from sqlalchemy.orm import Session
+
+    session = Session(bind=engine.execution_options(sqlite_immediate=True))  # it may write
+
+    if session.query(MixingRatios).count() < session.query(Datum).count():
+        print('Filling the mixing_ratios table from existing data.')
+        refresh_mixing_ratios(session)  # fills the table for dbs created before it existed
+        session.commit()
+
+    if session.query(DailySummary).count() == 0 and session.query(MixingRatios).count() > 0:
+        print('Filling the daily_summaries table from existing data.')
+        refresh_daily_summaries(session)
+        session.commit()
+
+    session.close()
+
+
+def connect_to_reservoir_db(engine_str, directory, write=False):
+    """
+    Example:
+    engine, session, Base = connect_to_reservoir_db('sqlite:///reservoir.sqlite', dir)
+
+    Takes string name of the database to create/connect to, and the directory it should be in. The engine is
+    shared by the whole process (see get_reservoir_engine), so it should not be disposed; only close the session.
+
+    engine_str: str, name of the database to create/connect to.
+    directory: str/path, directory that the database should be made/connected to in.
+    write: bool, whether the session will write; only write sessions take the write lock when they begin
+    """
+
+    engine, Session = get_reservoir_engine(engine_str, directory, write)
+
+    return engine, Session(), Base
+
+def insert_or_ignore(table):
+    """
+    Returns an insert statement for table that skips any row conflicting with a unique constraint (ie a duplicate
+    date), so duplicates are rejected by the database rather than by checking against everything already in it.
+    """
+    return table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+
+
+def chunked(items, size=500):
+    """Yields successive lists of at most size items, ie to stay under SQLite's limit on bound parameters."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_insert_objects(session, objects, table=None):
+    """
+    Inserts mapped objects of a single class with one executemany through SQLAlchemy Core, rather than merging
+    each one through the ORM (which does a SELECT per object). Rows that duplicate a unique column already in the
+    database are ignored. The session is not committed.
+
+    Only works for classes whose attribute names match their column names, ie LogFile and Crf, or records
+    with the same attributes, like LogRecord.
+
+    session: the session to insert with
+    objects: list, of mapped objects; these are not added to the session and should be discarded afterwards
+    table: Table, to insert into; defaults to the table of the objects' class
+    """
+
+    if len(objects) == 0:
+        return
+
+    table = type(objects[0]).__table__ if table is None else table
+    columns = [col.name for col in table.columns if col.name != 'id']
+    rows = [{col: getattr(obj, col) for col in columns} for obj in objects]
+
+    session.execute(insert_or_ignore(table), rows)
+
+
+def bulk_insert_logs(session, LogFiles):
+    """
+    Inserts LogFile objects (or LogRecords) with one executemany; logs with a date already in the db are
+    ignored. See bulk_insert_objects.
+    """
+    bulk_insert_objects(session, LogFiles, LogFile.__table__)
+
+
+def bulk_insert_pa_columns(session, names, pa_lines):
+    """
+    Inserts lines parsed by read_pa_columns and their peaks straight from the columns, without creating an
+    NmhcLine or Peak for any of them. Lines with a date already in the db are ignored, along with their peaks.
+    The session is not committed.
+
+    session: the session to insert with
+    names: list, of peak names, as returned by read_pa_columns
+    pa_lines: list, of (date, name indices, rts, pas), as returned by read_pa_columns
+    """
+
+    bulk_insert_line_peaks(session, [(date, [{'name': names[index], 'pa': pa, 'mr': None, 'rt': rt, 'rev': 0, 'qc': 0}
+                                             for index, rt, pa in zip(indices.tolist(), rts.tolist(), pas.tolist())])
+                                     for date, indices, rts, pas in pa_lines])
+
+
+def bulk_insert_line_peaks(session, line_peaks):
+    """
+    Inserts nmhclines rows with one executemany, then the peaks of the lines that were actually inserted with
+    another. Lines with a date already in the db are ignored, along with their peaks.
+
+    New line ids are found by reading back any lines with an id above the previous max id, so the peaks can be
+    linked without a query per line.
+
+    session: the session to insert with
+    line_peaks: list, of (date, list of peak row dicts without a line_id) per line
+    """
+
+    from sqlalchemy import func
+
+    if len(line_peaks) == 0:
+        return
+
+    last_id = session.query(func.max(NmhcLine.id)).scalar() or 0
+
+    session.execute(insert_or_ignore(NmhcLine.__table__), [{'date': date, 'status': 'single'}
+                                                           for date, _ in line_peaks])
+
+    peaks_by_date = dict()
+    for date, peaks in line_peaks:
+        peaks_by_date.setdefault(date, peaks)  # the first line of any duplicated date is the one inserted
+    new_ids = session.query(NmhcLine.id, NmhcLine.date).filter(NmhcLine.id > last_id).all()
+
+    peak_rows = []
+    for line_id, date in new_ids:
+        peaks = peaks_by_date.get(date)
+
+        if peaks is None:
+            continue  # inserted by something else in the meantime
+
+        for peak in peaks:
+            peak['line_id'] = line_id
+            peak_rows.append(peak)
+
+    if len(peak_rows) != 0:
+        session.execute(Peak.__table__.insert(), peak_rows)
+
+
+def fix_off_dates(LogFiles, NmhcLines):
+    """
+    Loop through a provided list of LogFile objects and correct the dates if necessary.
+    A short period in the log files are mis-recorded, and a longer period in the NMHC_PA.LOG
+    were also mis-recorded.
+
+    % Correct dates for logdata - All dates prior to 13:00 MST on 4/11/2017
+    % have to be corrected. Those dates were recorded as MDT, so subtracting an
+    % hour will put them in MST. The first "correct" run was at 13:10 MST,
+    % and the last "bad" run was at 12:50 MDT.
+
+    % Correct dates for NMHC_PA Lines - All dates prior to 15:45 MST on 4/27/2017
+    % have to be corrected. Those dates were recorded as MDT, so subtracting an
+    % hour will put them in MST. The first "correct" run was at ~15:50 MST,
+    % and the last "bad" run was at 14:59 MDT.
+
+    Parameters:
+
+    LogFiles: list, of LogFile objects
+    NmhcLines: list, of NmhcLine objects
+    """
+
+    for log in LogFiles:
+        log.date = fix_log_date(log.date)
+
+    for line in NmhcLines:
+        line.date = fix_line_date(line.date)
+
+
+def fix_log_date(date):
+    """Returns a LogFile date corrected from MDT to MST if it was mis-recorded; see fix_off_dates."""
+    if datetime(2017,3,12,2,0,0) < date < datetime(2017,4,11,13,0,0):
+        return date - dt.timedelta(hours = 1)
+    return date
+
+
+def fix_line_date(date):
+    """Returns an NmhcLine date corrected from MDT to MST if it was mis-recorded; see fix_off_dates."""
+    if datetime(2017,3,12,2,0,0) < date < datetime(2017,4,27,15,5,0):
+        return date - dt.timedelta(hours = 1)
+    return date
+
+
+def read_new_lines(path, checkpoint, keepends=False, decode=True):
+    """
+    Reads only the complete lines appended to a file since the position recorded in checkpoint, and advances
+    the checkpoint past them. A partial line at the end of the file is left for the next call, so a line that
+    is still being written is never parsed early.
+
+    If the file shrank, was replaced (new inode), or no longer ends a line where the checkpoint says it should,
+    it's assumed to have been truncated or rotated and is read again from the beginning.
+
+    Lines are decoded as UTF-8 with any undecodable bytes replaced, so a corrupt line is rejected by the parser
+    rather than stopping every read at it.
+
+    path: str/path, full path to the file to read
+    checkpoint: FileCheckpoint, the stored position for this file; modified in place
+    keepends: bool, keep the line endings, ie so each line's length in bytes can be used to advance a checkpoint
+    decode: bool, if False the lines are returned as bytes, ie so their exact lengths in bytes are known
+    """
+
+    stat = os.stat(path)
+
+    with open(path, 'rb') as file:
+        if checkpoint.offset > 0:
+            if (stat.st_size < checkpoint.offset
+                    or (checkpoint.inode is not None and checkpoint.inode != stat.st_ino)):
+                print(f'File {path} was truncated or replaced; reading it from the beginning.')
+                checkpoint.offset = 0
+            else:
+                file.seek(checkpoint.offset - 1)
+                if file.read(1) != b'\n':  # the checkpoint should always sit just after a line ending
+                    print(f'File {path} changed before the last read position; reading it from the beginning.')
+                    checkpoint.offset = 0
+
+        file.seek(checkpoint.offset)
+        chunk = file.read(stat.st_size - checkpoint.offset)
+
+    consumed = chunk.rfind(b'\n') + 1  # only consume through the last complete line
+
+    checkpoint.offset += consumed
+    checkpoint.inode = stat.st_ino
+    checkpoint.size = stat.st_size
+
+    lines = chunk[:consumed].splitlines(keepends)
+
+    if not decode:
+        return lines
+
+    return [line.decode(errors='replace') for line in lines]
+
+
+class InotifyWatcher():
+    """
+    Minimal wrapper around Linux inotify, using ctypes so no extra packages are needed. The file descriptor is
+    non-blocking, so it can be registered with an asyncio loop's add_reader and drained with read_events().
+
+    Raises OSError if inotify isn't available (ie not on Linux), so callers can fall back to polling.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000  # events were dropped; reported with a watch descriptor of -1
+    IN_IGNORED = 0x00008000  # a watch was removed, ie because its file was deleted or replaced
+
+    _IN_NONBLOCK = 0o4000
+    _IN_CLOEXEC = 0o2000000
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self._libc.inotify_init1  # raises AttributeError if not present
+        except (OSError, AttributeError):
+            raise OSError('inotify is not available on this system.')
+
+        self.fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask):
+        """Watches a file or directory for the events in mask, and returns the watch descriptor for it."""
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+
+        return wd
+
+    def read_events(self):
+        """
+        Returns a list of all pending events as (watch descriptor, filename, mask) tuples, or an empty list if
+        there are none.
+        """
+        import struct
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(buffer):
+            wd, mask, _, length = struct.unpack_from('iIII', buffer, pos)
+            pos += 16  # size of the fixed inotify_event header
+            name = os.fsdecode(buffer[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, name, mask))
+
+        return events
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+def check_filesize(filename):
+    '''Returns filesize in bytes'''
+    if os.path.isfile(filename):
+        return os.path.getsize(filename)
+    else:
+        print(f'File {filename} not found.')
+        return
+
+
+class TempDir():
+    """
+    Context manager for working in a directory temporarily.
+
+    The working directory is shared by every thread in the process, so entering a TempDir takes a process-wide
+    lock until it's exited; other threads' TempDirs wait rather than changing directory underneath it. Code run
+    in threads alongside a TempDir should use absolute paths. The pipeline itself no longer uses this: file
+    reading, db and plotting functions all take explicit paths instead.
+    """
+    lock = threading.RLock()
+
+    def __init__(self, path):
+        self.new_dir = path
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.old_dir = os.getcwd()
+        os.chdir(self.new_dir)
+
+    def __exit__(self, *args):
+        try:
+            os.chdir(self.old_dir)
+        finally:
+            self.lock.release()
+
+
+def get_dates_mrs(res_session, compound, date_start=None, date_end=None):
+
+    if date_start is None and date_end is None:
+        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
+                     .join(NmhcLine).join(GcRun).join(LogFile)) # get everything
+        mrs, dates = zip(*peak_info.all())
+        return mrs, dates
+
+    elif date_start is None:
+        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
+                     .join(NmhcLine).join(GcRun).join(LogFile)
+                     .filter(LogFile.date < date_end)) # get only before the end date given
+        mrs, dates = zip(*peak_info.all())
+        return mrs, dates
+
+    elif date_end is None:
+        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
+                     .join(NmhcLine).join(GcRun).join(LogFile)
+                     .filter(LogFile.date > date_start))
+        mrs, dates = zip(*peak_info.all()) # get only after the start date given
+        return mrs, dates
+
+    else:
+        peak_info = (res_session.query(Peak.mr, LogFile.date).filter(Peak.name == compound)
+                     .join(NmhcLine).join(GcRun).join(LogFile)
+                     .filter(LogFile.date.between(date_start, date_end))) # get between date bookends (inclusive beginning!)
+        mrs, dates = zip(*peak_info.all())
+        return mrs, dates
+
+
+def get_dates_mrs_multi(res_session, compounds, date_start=None, date_end=None):
+    """
+    Gets the mixing ratios of several compounds with one query, pivoted onto one date axis, rather than
+    running the same join once per compound with get_dates_mrs.
+
+    Returns (dates, mrs), where dates is a sorted list of the run dates that had any of the compounds, and mrs is
+    a dict of {compound: list of mixing ratios} with each list aligned to dates. A compound missing from a run is
+    None at that date. If nothing is found, dates is empty.
+
+    Date filtering matches get_dates_mrs: after date_start if only it is given, before date_end if only it is
+    given, and between them (inclusive) if both are.
+
+    res_session: the session to query with
+    compounds: list, of compound names, ie ['ethane', 'propane']
+    """
+
+    peak_info = (res_session.query(LogFile.date, Peak.name, Peak.mr).filter(Peak.name.in_(compounds))
+                 .join(NmhcLine).join(GcRun).join(LogFile))
+
+    if date_start is not None and date_end is not None:
+        peak_info = peak_info.filter(LogFile.date.between(date_start, date_end))
+    elif date_start is not None:
+        peak_info = peak_info.filter(LogFile.date > date_start)
+    elif date_end is not None:
+        peak_info = peak_info.filter(LogFile.date < date_end)
+
+    dates = []
+    mrs = {compound: [] for compound in compounds}
+
+    seen = set()  # names already found at the current date
+    for date, name, mr in peak_info.order_by(LogFile.date, Peak.id):
+        if len(dates) == 0 or dates[-1] != date:
+            dates.append(date)
+            for series in mrs.values():
+                series.append(None)
+            seen.clear()
+
+        if name not in seen:
+            seen.add(name)
+            mrs[name][-1] = mr  # the first peak of a name in a run is the one used, as with GcRun.get_mr
+
+    return dates, mrs
+
+
+def plot_filename(compound_dict, suffix='last_week'):
+    """
+    Returns the filename res_nmhc_plot saves a plot of compound_dict as, made filename-safe from the legend items.
+    """
+
+    compounds_safe = []
+    for k, _ in compound_dict.items():
+        """Create a filename-safe list using the given legend items"""
+        compounds_safe.append(k.replace('-', '_').replace('/', '_').lower())
+
+    fn_list = '_'.join(compounds_safe)  # use 'safe' names for filename
+
+    return f'{fn_list}_{suffix}.png'
+
+
+def plot_compounds(groups=None):
+    """Returns a list of every compound needed to make the given plot groups (default plot_groups)."""
+
+    compounds = []
+    for group in (plot_groups if groups is None else groups):
+        for source in group['compounds'].values():
+            for compound in (source if isinstance(source, tuple) else (source,)):
+                if compound not in compounds:
+                    compounds.append(compound)
+
+    return compounds
+
+
+def build_plot_specs(dates, mrs, right, groups=None, windows=None):
+    """
+    Builds the spec (keyword arguments for res_nmhc_plot) of every plot group for every window, from data fetched
+    once for the widest window. Each window is sliced out of the sorted dates with a bisect, keeping one point
+    beyond each edge so lines run off the plot rather than stopping short of it. Lines in windows with a
+    'max_points' are downsampled with lttb, and so carry their own dates; a line with no values in the window is
+    left off that plot, and the plot is only skipped if every line is empty. Each spec's filename is made from the
+    whole group, so leaving a line off doesn't change where the plot is saved.
+
+    dates: list, of sorted datetimes, ie from get_wide_mrs
+    mrs: dict, of {compound: list of mixing ratios} aligned with dates; must contain all of plot_compounds(groups)
+    right: datetime, the right edge of every window
+    groups: list, of plot groups; defaults to plot_groups
+    windows: list, of plot windows; defaults to plot_windows
+    """
+    from bisect import bisect_left, bisect_right
+
+    groups = plot_groups if groups is None else groups
+    windows = plot_windows if windows is None else windows
+
+    specs = []
+
+    for window in windows:
+        left = right - dt.timedelta(days=window['days'])
+
+        lo = max(bisect_left(dates, left) - 1, 0)
+        hi = min(bisect_right(dates, right) + 1, len(dates))
+
+        if lo >= hi:
+            continue  # nothing at all in this window
+
+        major_ticks = []
+        tick = right
+        while tick >= left:
+            major_ticks.append(tick)
+            tick -= window['major_ticks']
+
+        minor_ticks = []
+        tick = right
+        while tick >= left:
+            minor_ticks.append(tick)
+            tick -= window['minor_ticks']
+
+        for group in groups:
+            compound_dict = dict()
+
+            for name, source in group['compounds'].items():
+                if isinstance(source, tuple):
+                    numerator, denominator = source
+
+                    ratio = []
+                    for i, n in zip(mrs[numerator][lo:hi], mrs[denominator][lo:hi]):  # aligned, so pairs are one run
+                        if n == 0 or n == None:
+                            ratio.append(None)
+                        elif i == None:
+                            ratio.append(None)
+                        else:
+                            ratio.append(i/n)
+
+                    compound_dict[name] = [None, ratio]
+                else:
+                    compound_dict[name] = [None, mrs[source][lo:hi]]
+
+            window_dates = dates[lo:hi]
+
+            filename = plot_filename(compound_dict, window['suffix'])
+
+            if window.get('max_points'):
+                for name, (_, values) in list(compound_dict.items()):
+                    line_dates, line_values = lttb(window_dates, values, window['max_points'])
+
+                    if len(line_dates) == 0:
+                        del compound_dict[name]  # a line with no values can't be plotted with its own dates
+                    else:
+                        compound_dict[name] = [line_dates, line_values]
+
+                if len(compound_dict) == 0:
+                    continue  # every line was empty, so there's nothing to plot
+
+                window_dates = None  # each line now has its own dates
+
+            limits = dict({'right': right, 'left': left, 'bottom': 0}, **group.get('limits', dict()))
+
+            specs.append({'dates': window_dates, 'compound_dict': compound_dict, 'limits': limits,
+                          'major_ticks': major_ticks, 'minor_ticks': minor_ticks, 'suffix': window['suffix'],
+                          'filename': filename})
+
+    return specs
+
+
+def plot_fingerprint(spec):
+    """
+    Returns a hash of everything that goes into a plot (its data, limits and ticks), so a plot only needs to be
+    rendered again when this changes.
+
+    spec: dict, of keyword arguments for res_nmhc_plot
+    """
+    import hashlib
+
+    return hashlib.sha1(repr(sorted(spec.items())).encode()).hexdigest()
+
+
+def res_nmhc_plot(dates, compound_dict, limits=None, minor_ticks=None, major_ticks=None, suffix='last_week',
+                  plotdir=None, filename=None):
+    """
+    Versatile dat plotter for the project with a dynamic duration/tick scheme for web-ready plots.
+
+    Example with all dates supplied:
+        res_nmhc_plot((None, {'Ethane':[[date, date, date], [1, 2, 3]],
+                                'Propane':[[date, date, date], [.5, 1, 1.5]]}))
+
+    Example with single date list supplied:
+        res_nmhc_plot([date, date, date], {'ethane':[None, [1, 2, 3]],
+                                'propane':[None, [.5, 1, 1.5]]})
+
+    dates: list, of Python datetimes; if set, this applies to all compounds.
+        If None, each compound supplies its own date values
+    compound_dict: dict, {'compound_name':[dates, mrs]}
+        keys: str, the name to be plotted and put into filename
+        values: list, len(list) == 2, two parallel lists that are...
+            dates: list, of Python datetimes. If None, dates come from dates input parameter (for all compounds)
+            mrs: list, of [int/float/None]s; these are the mixing ratios to be plotted
 
     limits: dict, optional dictionary of limits including ['top','bottom','right','left']
     major_ticks: list, of major tick marks
     minor_ticks: list, of minor tick marks
+    suffix: str, appended to the filename to name the time window, ie 'last_week'
+    plotdir: str/path, directory to save the plot in; if None, it's saved in the working directory
+    filename: str, name to save the plot as; if None, it's made from compound_dict and suffix by plot_filename
     """
 
     import matplotlib.pyplot as plt
@@ -895,13 +2683,7 @@ def res_nmhc_plot(dates, compound_dict, limits=None, minor_ticks=None, major_tic
         for compound, val_list in compound_dict.items():
             ax.plot(dates, val_list[1], '-o')
 
-    compounds_safe = []
-    for k, _ in compound_dict.items():
-        """Create a filename-safe list using the given legend items"""
-        compounds_safe.append(k.replace('-', '_').replace('/', '_').lower())
-
     comp_list = ', '.join(compound_dict.keys())  # use real names for plot title
-    fn_list = '_'.join(compounds_safe)  # use 'safe' names for filename
 
     if limits is not None:
         ax.set_xlim(right=limits.get('right'))
@@ -928,10 +2710,39 @@ def res_nmhc_plot(dates, compound_dict, limits=None, minor_ticks=None, major_tic
 
     f1.subplots_adjust(bottom=.20)
 
-    f1.savefig(f'{fn_list}_last_week.png', dpi=150)
+    if filename is None:
+        filename = plot_filename(compound_dict, suffix)
+    if plotdir is not None:
+        filename = os.path.join(plotdir, filename)
+
+    f1.savefig(filename, dpi=150)
     plt.close(f1)
 
 
+def init_plot_worker():
+    """
+    Initializer for plot worker processes (see render_plot). Selects the non-interactive Agg backend and imports
+    pyplot once per worker, so individual plots don't pay for it.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+    import matplotlib.pyplot
+
+
+def render_plot(plotdir, spec):
+    """
+    Renders one plot into plotdir, in a worker process of a ProcessPoolExecutor made with
+    initializer=init_plot_worker. Plots are submitted as data-only specs so they can be pickled to the worker,
+    and rendering never blocks the asyncio loop of the submitting process.
+
+    plotdir: str/path, directory the plot should be saved in
+    spec: dict, of keyword arguments for res_nmhc_plot, ie {'dates': ..., 'compound_dict': ..., 'limits': ...}
+    """
+
+    res_nmhc_plot(plotdir=plotdir, **spec)
+
+
 def get_peak_data(run):
     """Useful for extracing all peak info from newly created GcRuns or Datums in service of integration corrections."""
     pas = [peak.pa for peak in run.peaks]
@@ -947,12 +2758,14 @@ def check_c4_rts(run):
     Acetylene and n-butane are not always caught by PeakSimple correctly, but several rules lead to much better
     integrations. Checking their retention times against i-butane is quite reliable. This takes one run at a time and
     if acetylene or n-butane do not match conditions, it finds the correct peaks (or at the very least un-labels
-    incorrect matches).
+    incorrect matches). Peaks are found through the run's cached name index and rt view (see PeakIndexMixin).
     """
 
     if run is None:
         return None  # added so this can be passed a None during integrations w/o issue
 
+    named_peaks = run.peak_index()  # taken once; the renames below don't change which peaks are found in it
+
     ibut_rt = run.get_rt('i-butane')
     nbut_rt = run.get_rt('n-butane')
     acet_rt = run.get_rt('acetylene')
@@ -967,7 +2780,7 @@ def check_c4_rts(run):
                 pass
             else:
                 find_nbut = True  # needs to be found now
-                pseudo_nbut = search_for_attr_value(run.peaks, 'name', 'n-butane')
+                pseudo_nbut = named_peaks['n-butane']
                 pseudo_nbut.name = '-'  # rename the imposter to null name
 
         if acet_rt is not None:
@@ -975,12 +2788,12 @@ def check_c4_rts(run):
             if .3 < acet_diff < .4:
                 pass
             else:
-                pseudo_acet = search_for_attr_value(run.peaks, 'name', 'acetylene')
+                pseudo_acet = named_peaks['acetylene']
                 pseudo_acet.name = '-'  # rename the imposter to null name
                 find_acet = True  # needs to be found now
 
         if acet_rt is None or find_acet:
-            acet_pool = [peak for peak in run.peaks if .3 < (peak.rt - ibut_rt) < .4]
+            acet_pool = run.peaks_near_rt(ibut_rt, .3, .4)
 
             if len(acet_pool) == 0:
                 pass
@@ -989,7 +2802,7 @@ def check_c4_rts(run):
                 acet.name = 'acetylene'
 
         if nbut_rt is None or find_nbut:
-            nbut_pool = [peak for peak in run.peaks if .42< (peak.rt - ibut_rt) < .46]
+            nbut_pool = run.peaks_near_rt(ibut_rt, .42, .46)
 
             if len(nbut_pool) == 0:
                 pass